@@ -0,0 +1,308 @@
+import array
+import struct
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from TagTools import *
+
+TagBenchmarkShapes = ("nested", "floats", "items", "pointers")
+TagBenchmarkOperations = ("write", "read", "serialize", "parse")
+
+class TagBenchmarkBuilder(object):
+    def __init__(self, types, seed = 0):
+        self.types = types
+        self.typeNames = {}
+        self.random = random.Random(seed)
+
+        for typ in types:
+            if typ:
+                self.typeNames.setdefault(typ.name, typ)
+
+    def findType(self, name):
+        return self.typeNames[name]
+
+    def makeFloat(self):
+        return struct.unpack("<f", struct.pack("<f", self.random.uniform(-100.0, 100.0)))[0]
+
+    def makeValue(self, typ, value):
+        superType = typ.superType
+
+        if superType.subType == TagSubType.Pointer:
+            return TagObject(value, typ)
+
+        elif superType.subType == TagSubType.Class:
+            members = {x.name:x for x in superType.allMembers}
+            return TagObject({x:self.makeValue(members[x].typ, y) for x, y in value.iteritems()}, typ)
+
+        elif superType.subType == TagSubType.Tuple:
+            return TagObject([self.makeValue(superType.pointer, x) for x in value], typ)
+
+        elif superType.subType == TagSubType.Array:
+            arrayType = TagReader.makeArrayType(superType.pointer)
+
+            # Numeric arrays look the way the reader and parser produce them
+            if arrayType != None:
+                code, stride = arrayType
+                values = array.array(code, [y for x in value for y in x] if stride > 1 else value)
+                return TagObject(TagArray(superType.pointer, values, stride), typ)
+
+            return TagObject([self.makeValue(superType.pointer, x) for x in value], typ)
+
+        return TagObject(value, typ)
+
+    def makeObject(self, name, value):
+        return self.makeValue(self.findType(name), value)
+
+    def makeVector(self):
+        return [self.makeFloat() for x in xrange(4)]
+
+    def makeTransform(self):
+        return {"translation":self.makeVector(), "rotation":self.makeVector(), "scale":self.makeVector()}
+
+    def makeRoot(self, obj):
+        # The writer takes the string type from an hkBool, so every file gets a one bone skeleton too
+        skeleton = self.makeObject("hkaSkeleton", {"name":"root", "bones":[{"name":"root", "lockTranslation":True}]})
+        
+        variants = [{"name":x.typ.name, "className":x.typ.name, "variant":x} for x in (obj, skeleton)]
+        return self.makeObject("hkRootLevelContainer", {"namedVariants":variants})
+
+    # A chain of materials, each one the only sub-material of the previous
+    def makeNested(self, count):
+        obj = None
+
+        for i in xrange(count):
+            value = {"name":"material{}".format(i), "diffuseColor":self.makeVector(), "specularMultiplier":self.makeFloat()}
+
+            if obj != None:
+                value["subMaterials"] = [obj]
+
+            obj = self.makeObject("hkxMaterial", value)
+
+        return self.makeRoot(obj)
+
+    # A few large float arrays
+    def makeFloats(self, count):
+        return self.makeRoot(self.makeObject("hkaInterleavedUncompressedAnimation", {
+        	"duration":self.makeFloat(),
+        	"numberOfTransformTracks":count // 16,
+        	"numberOfFloatTracks":count,
+        	"transforms":[self.makeTransform() for x in xrange(count // 16)],
+        	"floats":[self.makeFloat() for x in xrange(count)]}))
+
+    # Lots of bones, every name is an item of its own
+    def makeItems(self, count):
+        return self.makeRoot(self.makeObject("hkaSkeleton", {
+        	"name":"skeleton",
+        	"parentIndices":[x - 1 for x in xrange(count)],
+        	"bones":[{"name":"bone{}".format(x), "lockTranslation":x % 2 == 1} for x in xrange(count)],
+        	"referencePose":[self.makeTransform() for x in xrange(count)]}))
+
+    # Lots of small objects reached through pointers
+    def makePointers(self, count):
+        bindings = []
+
+        for i in xrange(count):
+            binding = self.makeObject("hkaAnimationBinding", {
+            	"originalSkeletonName":"skeleton{}".format(i % 8),
+            	"transformTrackToBoneIndices":[i % 100, (i + 1) % 100],
+            	"blendHint":i % 2})
+
+            bindings.append(binding)
+
+        return self.makeRoot(self.makeObject("hkaAnimationContainer", {"bindings":bindings}))
+
+    def makeShape(self, shape, count):
+        return {"nested":self.makeNested, "floats":self.makeFloats, "items":self.makeItems,
+        	"pointers":self.makePointers}[shape](count)
+
+class TagBenchmark(object):
+    # Object count for every shape at scale 1
+    counts = {"nested":100, "floats":400000, "items":20000, "pointers":10000}
+
+    def __init__(self, scale = 1.0, repeat = 1, shapes = TagBenchmarkShapes):
+        self.scale = scale
+        self.repeat = repeat
+        self.shapes = shapes
+        self.typesFileName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "TypeDatabase.xml")
+
+    def getCount(self, shape):
+        return max(1, int(TagBenchmark.counts[shape] * self.scale))
+
+    @staticmethod
+    def countObjects(obj):
+        count = 0
+        visited = set()
+        stack = [obj]
+
+        while stack:
+            obj = stack.pop()
+
+            if obj == None or id(obj) in visited:
+                continue
+
+            visited.add(id(obj))
+            count += 1
+
+            subType = obj.typ.superType.subType
+
+            if subType == TagSubType.Pointer:
+                stack.append(obj.value)
+
+            elif subType == TagSubType.Class:
+                stack.extend(obj.value.values())
+
+            elif isinstance(obj.value, TagArray):
+                count += len(obj.value) * (1 + obj.value.stride if obj.value.stride > 1 else 1)
+
+            elif subType & 0xF == TagSubType.Array:
+                stack.extend(obj.value)
+
+        return count
+
+    @staticmethod
+    def getPeakMemory():
+        if resource == None:
+            return None
+
+        # Bytes on macOS, kilobytes everywhere else
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    # Runs in a fresh interpreter so every case gets its own peak memory figure
+    @staticmethod
+    def runCase(operation, shape, count, tagFileName, xmlFileName, typesFileName):
+        if operation == "write":
+            obj = TagBenchmarkBuilder(TagTypeHelper.loadTypes(typesFileName)).makeShape(shape, count)
+            begin = time.time()
+            TagWriter.toFile(tagFileName, obj)
+
+        elif operation == "read":
+            begin = time.time()
+            TagReader.fromFile(tagFileName)
+
+        elif operation == "serialize":
+            obj = TagReader.fromFile(tagFileName)
+            begin = time.time()
+            TagXmlSerializer.toFile(xmlFileName, obj, TagTypeBackporter.backportTypes2012)
+
+        elif operation == "parse":
+            types = TagTypeHelper.loadTypes(typesFileName)
+            begin = time.time()
+            TagXmlParser.fromFile(xmlFileName, types)
+
+        return {"seconds":time.time() - begin, "peak":TagBenchmark.getPeakMemory()}
+
+    def startCase(self, operation, shape, count, tagFileName, xmlFileName):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--case",
+        	operation, shape, str(count), tagFileName, xmlFileName, self.typesFileName])
+
+        return json.loads(output.splitlines()[-1])
+
+    def run(self):
+        results = []
+        directory = tempfile.mkdtemp("", "TagBenchmark")
+
+        try:
+            for shape in self.shapes:
+                count = self.getCount(shape)
+                tagFileName = os.path.join(directory, shape + ".hkx")
+                xmlFileName = os.path.join(directory, shape + ".xml")
+
+                obj = TagBenchmarkBuilder(TagTypeHelper.loadTypes(self.typesFileName)).makeShape(shape, count)
+                objectCount = TagBenchmark.countObjects(obj)
+                del obj
+
+                for operation in TagBenchmarkOperations:
+                    cases = [self.startCase(operation, shape, count, tagFileName, xmlFileName) for x in xrange(self.repeat)]
+                    best = min(cases, key = lambda x: x["seconds"])
+
+                    # Writers are measured by what they produce, readers by what they consume
+                    fileName = tagFileName if operation == "write" or operation == "read" else xmlFileName
+
+                    results.append({"shape":shape, "operation":operation, "count":count,
+                    	"bytes":os.path.getsize(fileName), "objects":objectCount,
+                    	"seconds":best["seconds"], "peak":max(x["peak"] for x in cases)})
+
+                    TagBenchmark.printResult(results[-1])
+
+        finally:
+            shutil.rmtree(directory)
+
+        return results
+
+    @staticmethod
+    def printHeader():
+        print "{:<10}{:<11}{:>10}{:>10}{:>10}{:>13}{:>10}".format(
+        	"shape", "operation", "size MB", "seconds", "MB/s", "objects/s", "peak MB")
+
+    @staticmethod
+    def printResult(result):
+        seconds = max(result["seconds"], 1e-6)
+        size = result["bytes"] / 1048576.0
+        peak = "{:.1f}".format(result["peak"] / 1048576.0) if result["peak"] != None else "-"
+
+        print "{:<10}{:<11}{:>10.2f}{:>10.3f}{:>10.2f}{:>13.0f}{:>10}".format(
+        	result["shape"], result["operation"], size, result["seconds"], size / seconds, result["objects"] / seconds, peak)
+
+    @staticmethod
+    def compare(results, baseline, tolerance):
+        times = {(x["shape"], x["operation"], x["count"]):x["seconds"] for x in baseline}
+        regressions = 0
+
+        for result in results:
+            key = (result["shape"], result["operation"], result["count"])
+
+            if times.has_key(key) and result["seconds"] > times[key] * (1.0 + tolerance):
+                regressions += 1
+                print "REGRESSION: {} {} took {:.3f}s, baseline {:.3f}s".format(
+                	result["shape"], result["operation"], result["seconds"], times[key])
+
+        return regressions
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+
+    if len(args) == 7 and args[0] == "--case":
+        print json.dumps(TagBenchmark.runCase(args[1], args[2], int(args[3]), args[4], args[5], args[6]))
+        sys.exit(0)
+
+    options = {"--scale":"1", "--repeat":"1", "--shapes":",".join(TagBenchmarkShapes),
+    	"--save":None, "--compare":None, "--tolerance":"0.2"}
+
+    while args:
+        if len(args) < 2 or not options.has_key(args[0]):
+            print "Benchmarks TagTools on synthetic tag files built from TypeDatabase.xml."
+            print "\nUsage: {} [--scale N] [--repeat N] [--shapes {}]".format(
+            	os.path.basename(sys.argv[0]), ",".join(TagBenchmarkShapes))
+            print "       [--save results.json] [--compare results.json] [--tolerance 0.2]"
+            print "Every case runs in its own process. --compare reports cases that got slower"
+            print "than the saved results by more than the tolerance and exits with an error."
+            sys.exit(1)
+
+        options[args[0]] = args[1]
+        del args[:2]
+
+    benchmark = TagBenchmark(float(options["--scale"]), int(options["--repeat"]), options["--shapes"].split(","))
+
+    TagBenchmark.printHeader()
+    results = benchmark.run()
+
+    if options["--save"] != None:
+        with open(options["--save"], "w") as f:
+            json.dump(results, f, indent = 2)
+
+    if options["--compare"] != None:
+        with open(options["--compare"]) as f:
+            if TagBenchmark.compare(results, json.load(f), float(options["--tolerance"])):
+                sys.exit(1)
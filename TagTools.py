@@ -1,11 +1,31 @@
 import struct
+import array
 
 import sys
 import os
+import errno
+import mmap
+import hashlib
+import cPickle
+import marshal
+import cStringIO
+import glob
+import shutil
+import multiprocessing
+import tempfile
+import json
+import socket
+import stat
 
 import xml.etree.cElementTree as ET
 
 import subprocess
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
    
 class TagSubType(object):
     Void = 0x0
@@ -37,6 +57,8 @@ class TagFlag(object):
     Unknown = 0x80
     
 class TagMember(object):
+    __slots__ = ("name", "flags", "byteOffset", "typ", "tag")
+    
     def __init__(self):
         self.name = ""
         self.flags = 0
@@ -45,6 +67,8 @@ class TagMember(object):
         self.tag = None
         
 class TagTemplate(object):
+    __slots__ = ("name", "value")
+    
     def __init__(self, name = "v", value = 0):
         self.name = name
         self.value = value
@@ -58,6 +82,9 @@ class TagTemplate(object):
         return self.name[0] == "t"
     
 class TagType(object):
+    __slots__ = ("name", "templates", "parent", "flags", "subTypeFlags", "pointer", "version",
+    	"byteSize", "alignment", "abstractValue", "members", "interfaces", "hsh", "tag")
+    
     def __init__(self, name = ""):
         self.name = name
         self.templates = []
@@ -100,12 +127,153 @@ class TagType(object):
         return self.subTypeFlags >> 8
 
 class TagObject(object):
+    __slots__ = ("value", "typ", "attachment")
+    
     def __init__(self, value, typ):
         self.value = value
         self.typ = typ
         self.attachment = None
         
+    # Only freshly read objects are pickled, they have no attachment yet
+    def __reduce__(self):
+        return TagObject, (self.value, self.typ)
+        
+class TagArray(object):
+    __slots__ = ("typ", "values", "stride")
+    
+    def __init__(self, typ, values, stride = 1):
+        self.typ = typ
+        self.values = values
+        self.stride = stride
+        
+    def __len__(self):
+        return len(self.values) // self.stride
+        
+    def __iter__(self):
+        for i in xrange( len(self) ):
+            yield self.makeObject(i)
+        
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.makeObject(x) for x in xrange( *index.indices( len(self) ) )]
+            
+        if index < 0:
+            index += len(self)
+            
+        if index < 0 or index >= len(self):
+            raise IndexError("TagArray index out of range")
+            
+        return self.makeObject(index)
+        
+    def __setitem__(self, index, obj):
+        self[index].value = obj.value
+        
+    def makeObject(self, index):
+        if self.stride == 1:
+            return TagArrayElement(self.values, index, 0, self.typ)
+            
+        return TagArrayElement(self.values, index * self.stride, self.stride, self.typ)
+        
+class TagArrayElement(TagObject):
+    __slots__ = ("values", "position", "size")
+    
+    def __init__(self, values, position, size, typ):
+        self.values = values
+        self.position = position
+        self.size = size
+        self.typ = typ
+        self.attachment = None
+        
+    def getValue(self):
+        if self.size == 0:
+            return self.values[self.position]
+            
+        pointer = self.typ.superType.pointer
+        
+        return tuple([TagArrayElement(self.values, x, 0, pointer)
+            for x in xrange(self.position, self.position + self.size)])
+            
+    def setValue(self, value):
+        if self.size == 0:
+            self.values[self.position] = value
+            return
+            
+        if len(value) != self.size:
+            raise ValueError("Tuple size doesn't match the array")
+            
+        for i in xrange(self.size):
+            self.values[self.position + i] = value[i].value
+            
+    # Elements are built on access, so reads and writes go straight to the array
+    value = property(getValue, setValue)
+    
+class TagLazyClass(object):
+    __slots__ = ("r", "typ", "offset", "members", "objects")
+    
+    def __init__(self, r, typ, offset):
+        self.r = r
+        self.typ = typ
+        self.offset = offset
+        self.members = {x.name:x for x in typ.allMembers}
+        self.objects = {}
+        
+    def __len__(self):
+        return len(self.members)
+        
+    def __iter__(self):
+        return iter(self.members)
+        
+    def __contains__(self, name):
+        return name in self.members
+        
+    def __getitem__(self, name):
+        if not self.objects.has_key(name):
+            member = self.members[name]
+            self.objects[name] = self.r.readObject(member.typ, self.offset + member.byteOffset)
+            
+        return self.objects[name]
+        
+    def has_key(self, name):
+        return name in self.members
+        
+    def get(self, name, default = None):
+        if name in self.members:
+            return self[name]
+            
+        return default
+        
+    def keys(self):
+        return self.members.keys()
+        
+    def values(self):
+        return [self[x] for x in self.members]
+        
+    def items(self):
+        return [(x, self[x]) for x in self.members]
+        
+    def iteritems(self):
+        for x in self.members:
+            yield x, self[x]
+            
+class TagLazyArray(object):
+    __slots__ = ("r", "item")
+    
+    def __init__(self, r, item):
+        self.r = r
+        self.item = item
+        
+    def __len__(self):
+        return self.item.count
+        
+    def __iter__(self):
+        return iter(self.r.readItem(self.item))
+        
+    def __getitem__(self, index):
+        return self.r.readItem(self.item)[index]
+        
 class TagItem(object):
+    __slots__ = ("typ", "offset", "count", "isPtr", "value")
+    
     def __init__(self):
         self.typ = None
         self.offset = 0
@@ -116,23 +284,23 @@ class TagItem(object):
 class TagSectionReader(object):
     def __init__(self, r, *signatures):
         self.r = r
-        self.offset = r.f.tell() + 8
+        self.offset = r.position + 8
         self.size = (r.readFormat(">I") & 0x3FFFFFFF) - 8
-        self.signature = r.f.read( 4 )
+        self.signature = r.read( 4 )
         
         if not self.signature in signatures:
             raise ValueError( "Invalid signature, expected {}, got {}".format( ", ".join( signatures ), self.signature ) )
     
     @property
     def end(self):
-        return self.r.f.tell() >= (self.offset + self.size)
+        return self.r.position >= (self.offset + self.size)
             
     def __enter__(self):
-        self.r.f.seek(self.offset)
+        self.r.position = self.offset
         return self
         
     def __exit__(self, arg1, arg2, arg3):
-        self.r.f.seek(self.offset + self.size)
+        self.r.position = self.offset + self.size
 
 class TagFileType(object):
 	Invalid = -1
@@ -140,32 +308,67 @@ class TagFileType(object):
 	Compendium = 1
 
 class TagReader(object):
-    def __init__(self, f, compendium=None):
+    formats = {}
+    
+    # Structured data below this size is decoded without a process pool
+    parallelMinimum = 1 << 20
+    itemReader = None
+    itemObjects = None
+
+    def __init__(self, f, compendium=None, lazy=False):
         self.f = f
+        self.lazy = lazy
+        self.data = TagReader.mapFile(f)
+        self.position = 0
         self.dataOffset = 0
         self.types = []
         self.items = []
         self.ids = []
+        self.typeNames = {}
+        self.typeItems = {}
         self.compendium = compendium
+        self.decoders = {}
+        self.arrayTypes = {}
+        self.pending = None
         self.readRootSection()
         
     def __enter__(self):
         return self
         
     def __exit__(self, arg1, arg2, arg3):
-        if ( self.compendium != None ):
-            self.compendium.f.close()
+        self.close()
         
+    def close(self):
+        # Lazy objects keep decoding from the mapping after the file is closed
+        if isinstance(self.data, mmap.mmap) and not self.lazy:
+            self.data.close()
+            
         self.f.close()
     
+    @staticmethod
+    def mapFile(f):
+        # Map the whole file so every read below is a plain buffer access
+        try:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            
+        except (AttributeError, EnvironmentError, ValueError):
+            f.seek(0)
+            return f.read()
+    
     @staticmethod    
-    def fromFile(inputFileName, compendiumFileName = None):
-        compendium = None
-        if ( compendiumFileName != None and os.path.exists( compendiumFileName ) ):
-            compendium = TagReader( open( compendiumFileName, "rb" ) )
+    def fromFile(inputFileName, compendiumFileName = None, lazy = False, compendium = None, workers = 0):
+        if ( compendium == None ):
+            compendium = TagReader.loadCompendium( compendiumFileName )
         
-        with TagReader( open(inputFileName, "rb"), compendium ) as r:
+        with TagReader( open(inputFileName, "rb"), compendium, lazy ) as r:
+            if workers > 1 and not lazy:
+                r.readItemsInParallel(inputFileName, workers)
+                
             return r.getObject(0)
+            
+    @staticmethod
+    def loadCompendium(compendiumFileName):
+        return TagCompendium.load(compendiumFileName)
 
     @staticmethod
     def checkFile(inputFileName):
@@ -183,7 +386,7 @@ class TagReader(object):
     def readTypeSection(self):
         with TagSectionReader(self, "TYPE", "TCRF") as t1:
             if ( t1.signature == "TCRF" ):
-                compendiumId = self.f.read( 8 )
+                compendiumId = self.read( 8 )
                 
                 if ( self.compendium == None ):
                     raise ValueError( "Missing compendium, tag file cannot be parsed" )
@@ -191,14 +394,14 @@ class TagReader(object):
                 if ( compendiumId not in self.compendium.ids ):
                     raise ValueError( "Compendium ID could not be found" )
                 
-                self.types = self.compendium.types
+                self.types = self.compendium.ids[compendiumId]
                 return
             
             with TagSectionReader(self, "TPTR") as t2:
                 pass
                 
             with TagSectionReader(self, "TSTR") as t3:
-                typeStrings = self.f.read(t3.size).split("\0")
+                typeStrings = self.read(t3.size).split("\0")
                 
             with TagSectionReader(self, "TNAM", "TNA1") as t4:
                 typeCount = self.readPacked()
@@ -217,7 +420,7 @@ class TagReader(object):
                         typ.templates.append(template)
                     
             with TagSectionReader(self, "FSTR") as t5:
-                fieldStrings = self.f.read(t5.size).split("\0")
+                fieldStrings = self.read(t5.size).split("\0")
                 
             with TagSectionReader(self, "TBOD", "TBDY") as t6:
                 while not t6.end:
@@ -290,7 +493,7 @@ class TagReader(object):
         with TagSectionReader(self, "TAG0", "TCM0") as t1:
             if ( t1.signature == "TAG0" ):
                 with TagSectionReader(self, "SDKV") as t2:
-                    version = self.f.read( 8 )
+                    version = self.read( 8 )
                     if ( version != "20160100" and version != "20160200" and version != "20150100" ):
                         raise ValueError("Invalid SDK version.")
                     
@@ -303,9 +506,15 @@ class TagReader(object):
             elif ( t1.signature == "TCM0" ):
                 with TagSectionReader( self, "TCID" ) as t4:
                     for i in xrange( t4.size / 8 ):
-                        self.ids.append( self.f.read( 8 ) )
+                        self.ids.append( self.read( 8 ) )
                     
                 self.readTypeSection()
+                
+        for typ in self.types[1:]:
+            self.typeNames.setdefault(typ.name, typ)
+            
+        for item in self.items:
+            self.typeItems.setdefault(item.typ, item)
     
     @staticmethod
     def getFormatString(flags, signed = False):
@@ -329,12 +538,131 @@ class TagReader(object):
         else:
             return ret
     
+    @staticmethod
+    def getLayout(typ, offset, fields):
+        typOrg = typ
+        typ = typ.superType
+        
+        if typ.subType == TagSubType.Bool or typ.subType == TagSubType.Int:
+            format = TagReader.getFormatString(typ.subTypeFlags)
+            
+            if not format:
+                return None
+                
+            node = (typ.subType, typOrg, offset, format[-1])
+            fields.append(node)
+            return node
+            
+        elif typ.subType == TagSubType.Float:
+            node = (typ.subType, typOrg, offset, "f")
+            fields.append(node)
+            return node
+            
+        elif typ.subType == TagSubType.Class:
+            members = []
+            
+            for member in typ.allMembers:
+                node = TagReader.getLayout(member.typ, offset + member.byteOffset, fields)
+                
+                if node == None:
+                    return None
+                    
+                members.append((member.name, node))
+                
+            return (typ.subType, typOrg, members)
+            
+        elif typ.subType == TagSubType.Tuple:
+            elements = []
+            
+            for i in xrange(typ.tupleSize):
+                node = TagReader.getLayout(typ.pointer, offset + i * typ.pointer.superType.byteSize, fields)
+                
+                if node == None:
+                    return None
+                    
+                elements.append(node)
+                
+            return (typ.subType, typOrg, elements)
+        
+        return None
+        
+    def makeBuilder(self, node, indices):
+        subType, typ = node[0], node[1]
+        
+        if subType == TagSubType.Bool:
+            index = indices[id(node)]
+            return lambda values: TagObject(values[index] > 0, typ)
+            
+        elif subType == TagSubType.Int or subType == TagSubType.Float:
+            index = indices[id(node)]
+            return lambda values: TagObject(values[index], typ)
+            
+        elif subType == TagSubType.Class:
+            members = [(name, self.makeBuilder(x, indices)) for name, x in node[2]]
+            return lambda values: TagObject({name:build(values) for name, build in members}, typ)
+            
+        elif subType == TagSubType.Tuple:
+            elements = [self.makeBuilder(x, indices) for x in node[2]]
+            return lambda values: TagObject(tuple([build(values) for build in elements]), typ)
+        
+    @staticmethod
+    def compileLayout(typ):
+        fields = []
+        node = TagReader.getLayout(typ, 0, fields)
+        
+        if node == None:
+            return None
+            
+        fields.sort(key = lambda x: x[2])
+        
+        format = "<"
+        position = 0
+        indices = {}
+        
+        for field in fields:
+            if field[2] < position:
+                return None
+            
+            if field[2] > position:
+                format += "{}x".format(field[2] - position)
+                
+            format += field[3]
+            position = field[2] + struct.calcsize("<" + field[3])
+            indices[id(field)] = len(indices)
+        
+        if position > typ.superType.byteSize:
+            return None
+            
+        return node, struct.Struct(format), indices
+        
+    def compileDecoder(self, typ):
+        layout = TagReader.compileLayout(typ)
+        
+        if layout == None:
+            return None
+            
+        node, compiled, indices = layout
+        build = self.makeBuilder(node, indices)
+        
+        return lambda offset: build(compiled.unpack_from(self.data, offset))
+        
+    def getDecoder(self, typ):
+        if not self.decoders.has_key(typ):
+            self.decoders[typ] = self.compileDecoder(typ)
+            
+        return self.decoders[typ]
+    
     def readObject(self, typ, offset = 0):
         if offset == 0:
-            offset = self.f.tell()
+            offset = self.position
             
-        else:
-            self.f.seek(offset)
+        decoder = self.getDecoder(typ)
+        
+        if decoder != None:
+            self.position = offset + typ.superType.byteSize
+            return decoder(offset)
+            
+        self.position = offset
             
         typOrg = typ
         typ = typ.superType
@@ -345,7 +673,13 @@ class TagReader(object):
             value = self.readFormat( TagReader.getFormatString(typ.subTypeFlags) ) > 0
             
         elif typ.subType == TagSubType.String:
-            value = "".join( map(chr, [x.value for x in self.readItemPtr()[:-1]]) )
+            chars = self.readItemPtr()
+            
+            if isinstance(chars, TagArray):
+                value = chars.values[:-1].tostring()
+                
+            else:
+                value = "".join( map(chr, [x.value for x in chars[:-1]]) )
             
         elif typ.subType == TagSubType.Int:
             value = self.readFormat( TagReader.getFormatString(typ.subTypeFlags) )
@@ -363,38 +697,138 @@ class TagReader(object):
                 value = None
         
         elif typ.subType == TagSubType.Class:
-            value = {x.name:self.readObject(x.typ, offset + x.byteOffset)
-            	for x in typ.allMembers}
+            if self.lazy:
+                value = TagLazyClass(self, typ, offset)
+                
+            else:
+                value = {x.name:self.readObject(x.typ, offset + x.byteOffset)
+                	for x in typ.allMembers}
             	
         elif typ.subType == TagSubType.Array:
-            value = self.readItemPtr()
+            value = self.readItemPtr(self.lazy)
             
         elif typ.subType == TagSubType.Tuple:
             value = tuple([self.readObject(typ.pointer, offset + x * typ.pointer.superType.byteSize)
             	for x in xrange(typ.tupleSize)])
             	
-        self.f.seek(offset + typ.byteSize)
+        self.position = offset + typ.byteSize
         return TagObject(value, typOrg)
         
-    def readItemPtr(self):
+    def readItemPtr(self, lazy = False):
         index = self.readFormat("<I")
         
         if index == 0:
             return []
             
+        elif lazy and self.items[index].value == None:
+            return TagLazyArray(self, self.items[index])
+            
         else:
-            item = self.items[index]
+            return self.readItem(self.items[index])
             
-            if item.value == None:
-                item.value = [self.readObject(item.typ,
-                	item.offset + x * item.typ.superType.byteSize)
-                	for x in xrange(item.count)]
+    def readItem(self, item):
+        if item.value == None:
+            arrayType = self.getArrayType(item.typ)
+            
+            if arrayType != None:
+                code, stride = arrayType
+                
+                values = array.array(code)
+                values.fromstring(self.data[item.offset:item.offset + item.count * item.typ.superType.byteSize])
+                
+                if sys.byteorder == "big":
+                    values.byteswap()
+                
+                item.value = TagArray(item.typ, values, stride)
+                
+            else:
+                # Items reached while decoding wait in a queue instead of
+                # recursing, so long pointer chains can't hit the recursion limit
+                item.value = TagReader.makeShell(item)
+                
+                if self.pending != None:
+                    self.pending.append(item)
+                    
+                else:
+                    self.pending = [item]
+                    
+                    try:
+                        self.readPendingItems()
+                        
+                    finally:
+                        self.pending = None
+                	
+        return item.value
+        
+    def readPendingItems(self):
+        while self.pending:
+            item = self.pending.pop()
+            value = item.value
+            size = item.typ.superType.byteSize
+            
+            for i in xrange(item.count):
+                obj = self.readObject(item.typ, item.offset + i * size)
                 
-            return item.value
+                # Pointers may already refer to the first element
+                if i == 0:
+                    value[0].value = obj.value
+                    
+                else:
+                    value[i] = obj
+                    
+    @staticmethod
+    def makeShell(item):
+        if item.count > 0:
+            return [TagObject(None, item.typ)] + [None] * (item.count - 1)
+            
+        return []
+            
+    def getArrayType(self, typ):
+        if not self.arrayTypes.has_key(typ):
+            self.arrayTypes[typ] = TagReader.makeArrayType(typ)
+            
+        return self.arrayTypes[typ]
+        
+    @staticmethod
+    def makeArrayType(typ):
+        typ = typ.superType
+        stride = 1
+        
+        if typ.subType == TagSubType.Tuple:
+            stride = typ.tupleSize
+            element = typ.pointer.superType
+            
+        else:
+            element = typ
+            
+        code = None
+        
+        if element.subType == TagSubType.Float:
+            code = "f"
+            
+        elif element.subType == TagSubType.Int and not element.subTypeFlags & TagSubType.Int64:
+            code = TagReader.getFormatString(element.subTypeFlags)[-1:]
+            
+        if not code or array.array(code).itemsize != struct.calcsize("<" + code):
+            return None
+        
+        if typ.byteSize != stride * struct.calcsize("<" + code):
+            return None
+            
+        return code, stride
+
+    def read(self, size):
+        data = self.data[self.position:self.position + size]
+        self.position += size
+        return data
 
     def readFormat(self, format):
-        data = struct.unpack(format,
-        	self.f.read( struct.calcsize(format) ))
+        if not TagReader.formats.has_key(format):
+            TagReader.formats[format] = struct.Struct(format)
+            
+        compiled = TagReader.formats[format]
+        data = compiled.unpack_from(self.data, self.position)
+        self.position += compiled.size
 
         if len(data) == 1:
             return data[0]
@@ -422,17 +856,13 @@ class TagReader(object):
             return byte
             
     def getType(self, name):
-        for typ in self.types[1:]:
-            if typ.name == name:
-                return typ
+        return self.typeNames.get(name)
             
     def getItem(self, typ):
         if isinstance(typ, str):
             typ = self.getType(typ)
             
-        for item in self.items:
-            if item.typ == typ:
-                return item
+        return self.typeItems.get(typ)
             
     def getObject(self, index):
         item = self.items[ index + 1 ]
@@ -440,12 +870,207 @@ class TagReader(object):
         if item.typ == None:
             return None
         
-        if item.value == None:
-            item.value = [self.readObject(item.typ,
-            	item.offset + x * item.typ.superType.byteSize)
-            	for x in xrange(item.count)]
+        return self.readItem(item)[0]
+        
+    def makeShells(self):
+        # Numeric items are cheap to copy, structured ones get a first element that pointers can refer to early
+        for item in self.items:
+            if item.typ == None or item.value != None:
+                continue
+                
+            if self.getArrayType(item.typ) != None:
+                self.readItem(item)
+                
+            else:
+                item.value = TagReader.makeShell(item)
+                
+    def getSharedObjects(self):
+        # Every process builds these in the same order, so they can be left out of the pickled chunks
+        objs = [x for x in self.types if x != None]
+        
+        for item in self.items:
+            if item.value != None:
+                objs.append(item.value)
+                
+                if isinstance(item.value, list) and item.count > 0:
+                    objs.append(item.value[0])
+                    
+        return objs
+        
+    def getItemChunks(self, count):
+        # Taken before makeShells, the items it leaves as shells are the ones split up here
+        items = [(i, x) for i, x in enumerate(self.items)
+        	if x.typ != None and x.value == None and x.count > 0 and self.getArrayType(x.typ) == None]
+        	
+        total = sum(x.count * x.typ.superType.byteSize for i, x in items)
+        
+        if total < TagReader.parallelMinimum:
+            return []
+            
+        # Large items are split too, a single array of nodes is often most of the file
+        limit = max(1, total // count)
+        chunks = [[]]
+        size = 0
+        
+        for index, item in items:
+            elementSize = max(1, item.typ.superType.byteSize)
+            begin = 0
+            
+            while begin < item.count:
+                end = min(item.count, begin + max(1, (limit - size) // elementSize))
+                chunks[-1].append((index, begin, end))
+                
+                size += (end - begin) * elementSize
+                begin = end
+                
+                if size >= limit:
+                    chunks.append([])
+                    size = 0
+                    
+        return [x for x in chunks if x]
+        
+    def decodeItems(self, chunk, memo):
+        values = []
+        
+        for index, begin, end in chunk:
+            item = self.items[index]
+            size = item.typ.superType.byteSize
+            
+            values.append((index, begin, [self.readObject(item.typ, item.offset + x * size)
+            	for x in xrange(begin, end)]))
+            	
+        f = cStringIO.StringIO()
+        pickler = cPickle.Pickler(f, cPickle.HIGHEST_PROTOCOL)
+        
+        # Shared objects are written as memo references, the main process puts its own at the same indices
+        pickler.memo = {id(x):(i, x) for i, x in enumerate(memo)}
+        pickler.dump(values)
+        
+        return f.getvalue()
+        
+    def readItemsInParallel(self, inputFileName, workers):
+        chunks = self.getItemChunks(workers * 4)
+        
+        # Small files are left to the usual sequential read
+        if not chunks:
+            return
+            
+        self.makeShells()
+        
+        table = None
+        if ( self.compendium != None ):
+            table = (self.compendium.ids.keys(), TagTypeHelper.packTypes(self.types))
+            
+        memo = dict(enumerate(self.getSharedObjects()))
+        pool = multiprocessing.Pool(workers, initializer = initItemWorker, initargs = (inputFileName, table))
+        
+        try:
+            for data in pool.imap_unordered(decodeItemChunk, chunks):
+                unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+                unpickler.memo = memo.copy()
+                
+                for index, begin, objs in unpickler.load():
+                    value = self.items[index].value
+                    
+                    if begin == 0:
+                        value[0].value = objs[0].value
+                        objs[0] = value[0]
+                        
+                    value[begin:begin + len(objs)] = objs
+                    
+        finally:
+            pool.close()
+            pool.join()
+            
+def initItemWorker(inputFileName, table):
+    compendium = None
+    if ( table != None ):
+        compendium = TagCompendium(table[0], TagTypeHelper.unpackTypes(table[1]))
+        
+    TagReader.itemReader = TagReader(open(inputFileName, "rb"), compendium)
+    TagReader.itemReader.makeShells()
+    TagReader.itemObjects = TagReader.itemReader.getSharedObjects()
+    
+def decodeItemChunk(chunk):
+    return TagReader.itemReader.decodeItems(chunk, TagReader.itemObjects)
+        
+class TagCompendium(object):
+    # Packed type tables of every compendium loaded so far, by file identity
+    tables = {}
+    
+    def __init__(self, ids, types):
+        self.types = types
+        self.ids = {x:types for x in ids}
+        
+    @staticmethod
+    def load(compendiumFileName, cacheFileName = None):
+        if ( compendiumFileName == None or not os.path.exists( compendiumFileName ) ):
+            return None
+            
+        stat = os.stat(compendiumFileName)
+        fileKey = (os.path.abspath(compendiumFileName), stat.st_size, stat.st_mtime)
+        
+        if not TagCompendium.tables.has_key(fileKey):
+            TagCompendium.tables[fileKey] = TagCompendium.loadTable(compendiumFileName, cacheFileName)
+            
+        # The backporter edits types in place, so every load gets its own copy
+        ids, rows = TagCompendium.tables[fileKey]
+        return TagCompendium(ids, TagTypeHelper.unpackTypes(rows))
+        
+    @staticmethod
+    def loadTable(compendiumFileName, cacheFileName = None):
+        with open(compendiumFileName, "rb") as f:
+            key = hashlib.sha1( f.read() ).hexdigest()
+            
+        # Compendiums come from anywhere, their cache stays with the type database
+        if cacheFileName == None:
+            typesFileName = findFile("TypeDatabase.xml", False)
+            
+            if ( typesFileName != None ):
+                cacheFileName = os.path.join(os.path.dirname(typesFileName), "CompendiumCache", key + ".cache")
+            
+        table = None
+        if ( cacheFileName != None ):
+            table = TagTypeHelper.readCache(cacheFileName, key)
+        
+        if table == None:
+            with TagReader( open( compendiumFileName, "rb" ) ) as r:
+                table = (r.ids, TagTypeHelper.packTypes(r.types))
+                
+            if ( cacheFileName != None ):
+                TagTypeHelper.writeCache(cacheFileName, key, table)
             
-        return item.value[0]
+        return table
+        
+class TagBuffer(object):
+    def __init__(self, data = None):
+        if data == None:
+            data = bytearray()
+            
+        self.data = data
+        self.base = len(data)
+        self.position = 0
+        
+    def tell(self):
+        return self.position
+        
+    def seek(self, offset):
+        self.position = offset
+        
+    def write(self, data):
+        begin = self.base + self.position
+        
+        if begin > len(self.data):
+            self.data.extend( bytearray(begin - len(self.data)) )
+            
+        self.data[begin:begin + len(data)] = data
+        self.position += len(data)
+        
+    def getvalue(self):
+        if self.base == 0:
+            return self.data
+            
+        return self.data[self.base:]
         
 class TagSectionWriter(object):
     def __init__(self, w, signature, flag = True):
@@ -474,24 +1099,45 @@ class TagSectionWriter(object):
         self.w.f.seek(endOffset)
         
 class TagWriter(object):
-    def __init__(self, f):
-        self.f = f
+    def __init__(self, f, buffer = None):
+        self.output = f
+        self.f = TagBuffer(buffer)
         self.dataOffset = 0
         self.types = [None]
+        self.typeIndices = {None:0}
+        self.typeNames = {}
         self.items = [None]
+        self.itemIndices = {None:0}
         self.items2 = []
         self.patches = {}
+        self.encoders = {}
         
     def __enter__(self):
         return self
         
     def __exit__(self, arg1, arg2, arg3):
-        self.f.close()
+        if self.output != None:
+            if arg1 == None:
+                self.flush()
+                
+            self.output.close()
+            
+    def flush(self):
+        self.output.write(self.f.getvalue())
         
     @staticmethod
     def toFile(outputFileName, obj):
-        with TagWriter(open(outputFileName, "wb")) as w:
-            w.writeRootSection(obj)
+        # Serialize completely before opening, so a failure doesn't truncate the destination
+        data = TagWriter.toBuffer(obj)
+        
+        with open(outputFileName, "wb") as f:
+            f.write(data)
+            
+    @staticmethod
+    def toBuffer(obj, buffer = None):
+        w = TagWriter(None, buffer)
+        w.writeRootSection(obj)
+        return w.f.data
         
     def writeTypeSection(self):
         with TagSectionWriter(self, "TYPE", False) as t1:
@@ -500,17 +1146,22 @@ class TagWriter(object):
                 self.writeNulls(8 * len(self.types))
                 
             typeStrings = []
+            typeStringIndices = {}
             fieldStrings = []
+            fieldStringIndices = {}
             for typ in self.types[1:]:
-                if not typ.name in typeStrings:
+                if not typ.name in typeStringIndices:
+                    typeStringIndices[typ.name] = len(typeStrings)
                     typeStrings.append(typ.name)
                     
                 for template in typ.templates:
-                    if not template.name in typeStrings:
+                    if not template.name in typeStringIndices:
+                        typeStringIndices[template.name] = len(typeStrings)
                         typeStrings.append(template.name)
                         
                 for member in typ.members:
-                    if not member.name in fieldStrings:
+                    if not member.name in fieldStringIndices:
+                        fieldStringIndices[member.name] = len(fieldStrings)
                         fieldStrings.append(member.name)
                         
             with TagSectionWriter(self, "TSTR") as t3:
@@ -520,27 +1171,27 @@ class TagWriter(object):
                 self.writePacked( len(self.types) )
                 
                 for typ in self.types[1:]:
-                    self.writePacked(typeStrings.index(typ.name))
+                    self.writePacked(typeStringIndices[typ.name])
                     self.writePacked( len(typ.templates) )
                     
                     for template in typ.templates:
-                        self.writePacked(typeStrings.index(template.name))
-                        self.writePacked(self.types.index(template.value) if template.isType else template.value)
+                        self.writePacked(typeStringIndices[template.name])
+                        self.writePacked(self.typeIndices[template.value] if template.isType else template.value)
                 
             with TagSectionWriter(self, "FSTR") as t5:
                 self.f.write("\0".join(fieldStrings) + "\0")
                 
             with TagSectionWriter(self, "TBOD") as t6:
                 for typ in self.types[1:]:
-                    self.writePacked(self.types.index(typ))
-                    self.writePacked(self.types.index(typ.parent))
+                    self.writePacked(self.typeIndices[typ])
+                    self.writePacked(self.typeIndices[typ.parent])
                     self.writePacked(typ.flags)
                     
                     if typ.flags & TagFlag.SubType:
                         self.writePacked(typ.subTypeFlags)
                         
                     if typ.flags & TagFlag.Pointer:
-                        self.writePacked(self.types.index(typ.pointer))
+                        self.writePacked(self.typeIndices[typ.pointer])
                         
                     if typ.flags & TagFlag.Version:
                         self.writePacked(typ.version)
@@ -556,16 +1207,16 @@ class TagWriter(object):
                         self.writePacked( len(typ.members) )
                         
                         for member in typ.members:
-                            self.writePacked(fieldStrings.index(member.name))
+                            self.writePacked(fieldStringIndices[member.name])
                             self.writePacked(member.flags)
                             self.writePacked(member.byteOffset)
-                            self.writePacked(self.types.index(member.typ))
+                            self.writePacked(self.typeIndices[member.typ])
                             
                     if typ.flags & TagFlag.Interfaces:
                         self.writePacked( len(typ.interfaces) )
                         
                         for typ, flag in typ.interfaces:
-                            self.writePacked(self.types.index(typ))
+                            self.writePacked(self.typeIndices[typ])
                             self.writePacked(flag)    
      
             with TagSectionWriter(self, "THSH") as t7:
@@ -574,7 +1225,7 @@ class TagWriter(object):
                 self.writePacked( len(hashes) )
                 
                 for typ in hashes:
-                    self.writePacked(self.types.index(typ))
+                    self.writePacked(self.typeIndices[typ])
                     self.writeFormat("<I", typ.hsh)
                     
             with TagSectionWriter(self, "TPAD") as t8:
@@ -588,15 +1239,15 @@ class TagWriter(object):
                 
                 for item in self.items[1:]:
                     if item.isPtr:
-                        self.writeFormat("<I", self.types.index(item.typ) | 0x10000000)
+                        self.writeFormat("<I", self.typeIndices[item.typ] | 0x10000000)
                     else:
-                        self.writeFormat("<I", self.types.index(item.typ) | 0x20000000)
+                        self.writeFormat("<I", self.typeIndices[item.typ] | 0x20000000)
                    
                     self.writeFormat("<I", item.offset - self.dataOffset)
                     self.writeFormat("<I", len(item.value))
                    
             with TagSectionWriter(self, "PTCH") as t3:
-                patches = [(self.types.index(key), value)
+                patches = [(self.typeIndices[key], value)
                 	for key, value in self.patches.iteritems()]
                	
                 patches.sort(key=lambda x: x[0])
@@ -635,64 +1286,184 @@ class TagWriter(object):
             with TagSectionWriter(self, "DATA") as t3:
                 self.dataOffset = t3.headerOffset + 8
                 
-                while len(self.items2):
-                    items3 = self.items2
-                    self.items2 = []
+                data = bytearray( self.layoutItems() )
+                
+                for item in self.items[1:]:
+                    self.writeItem(data, item)
                     
-                    for item in items3:
-                        self.pad(self.nextPowerOfTwo(item.typ.superType.alignment))
-                        
-                        item.offset = self.f.tell()
-                        for i in xrange( len(item.value) ):
-                            self.writeObject(item.value[i], item.offset + i * item.typ.superType.byteSize)
-                        
-                self.pad(16)
+                self.f.write(data)
                 
             self.writeTypeSection()
             self.writeIndexSection()
+            
+    def layoutItems(self):
+        offset = self.dataOffset
         
-    def writeObject(self, obj, offset = 0):
-        if offset == 0:
-            offset = self.f.tell()
+        while len(self.items2):
+            items3 = self.items2
+            self.items2 = []
             
-        else:
-            self.f.seek(offset)
+            for item in items3:
+                offset = TagWriter.align(offset, self.nextPowerOfTwo(item.typ.superType.alignment))
+                
+                item.offset = offset
+                offset += len(item.value) * item.typ.superType.byteSize
+                
+                if not isinstance(item.value, TagArray):
+                    for obj in item.value:
+                        self.layoutObject(obj)
+                        
+        return TagWriter.align(offset, 16) - self.dataOffset
+        
+    def layoutObject(self, obj):
+        # Flat types can't reference other items
+        if self.getEncoder(obj.typ) != None:
+            return
             
         typ = obj.typ.superType
         
-        if typ.subType == TagSubType.Bool:
-            self.writeFormat(TagReader.getFormatString(typ.subTypeFlags), obj.value)
+        if typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
+            self.makeItem(obj)
             
-        elif typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
-            	
-            	item = self.makeItem(obj)
+        elif typ.subType == TagSubType.Class:
+            for member in typ.allMembers:
+                if obj.value.has_key(member.name):
+                    self.layoutObject(obj.value[member.name])
+                    
+        elif typ.subType == TagSubType.Tuple:
+            for i in xrange(typ.tupleSize):
+                self.layoutObject(obj.value[i])
+                
+    def writeItem(self, data, item):
+        offset = item.offset - self.dataOffset
+        byteSize = item.typ.superType.byteSize
+        
+        if isinstance(item.value, TagArray) and TagReader.makeArrayType(item.typ) == (item.value.values.typecode, item.value.stride):
+            values = item.value.values
+            
+            if sys.byteorder == "big":
+                values = array.array(values.typecode, values)
+                values.byteswap()
+                
+            data[offset:offset + len(item.value) * byteSize] = values.tostring()
+            
+        else:
+            for i in xrange( len(item.value) ):
+                self.writeObject(data, item.value[i], offset + i * byteSize)
+                
+    def writeObject(self, data, obj, offset):
+        encoder = self.getEncoder(obj.typ)
+        
+        if encoder != None:
+            encoder(data, obj, offset)
+            return
+            
+        typ = obj.typ.superType
+        
+        if typ.subType == TagSubType.Bool:
+            struct.pack_into(TagReader.getFormatString(typ.subTypeFlags), data, offset, obj.value)
+            
+        elif typ.subType == TagSubType.String or typ.subType == TagSubType.Pointer or typ.subType == TagSubType.Array:
+            	
+            	item = self.makeItem(obj)
             	if item != None:
-            	    self.addPatch(typ)
-            	    self.writeFormat("<I", self.items.index(item))
+            	    self.addPatch(typ, offset)
+            	    struct.pack_into("<I", data, offset, self.itemIndices[item])
             
         elif typ.subType == TagSubType.Int:
-            self.writeFormat(TagReader.getFormatString(typ.subTypeFlags, obj.value < 0), obj.value)
+            struct.pack_into(TagReader.getFormatString(typ.subTypeFlags, obj.value < 0), data, offset, obj.value)
         
         elif typ.subType == TagSubType.Float:
-            self.writeFormat("<f", obj.value)
+            struct.pack_into("<f", data, offset, obj.value)
         
         elif typ.subType == TagSubType.Class:
             for member in typ.allMembers:
                 if obj.value.has_key(member.name):
-                    self.writeObject(obj.value[member.name], offset + member.byteOffset)
+                    self.writeObject(data, obj.value[member.name], offset + member.byteOffset)
             	
         elif typ.subType == TagSubType.Tuple:
             for i in xrange(typ.tupleSize):
-                self.writeObject(obj.value[i], offset + i * typ.pointer.superType.byteSize)
+                self.writeObject(data, obj.value[i], offset + i * typ.pointer.superType.byteSize)
+                
+    def makeFlattener(self, node, indices):
+        subType = node[0]
+        
+        if subType == TagSubType.Bool or subType == TagSubType.Float:
+            index = indices[id(node)]
+            
+            def flatten(obj, values):
+                values[index] = obj.value
+                
+            return flatten
+            
+        elif subType == TagSubType.Int:
+            index = indices[id(node)]
             
-        self.f.seek(offset + typ.byteSize)
+            # Negative values go into unsigned fields as their two's complement
+            if node[3].isupper():
+                mask = (1 << (struct.calcsize("<" + node[3]) * 8)) - 1
+                
+                def flatten(obj, values):
+                    values[index] = obj.value & mask
+                    
+            else:
+                def flatten(obj, values):
+                    values[index] = obj.value
+                    
+            return flatten
+            
+        elif subType == TagSubType.Class:
+            members = [(name, self.makeFlattener(x, indices)) for name, x in node[2]]
+            
+            def flatten(obj, values):
+                value = obj.value
+                
+                for name, flattenMember in members:
+                    if value.has_key(name):
+                        flattenMember(value[name], values)
+                        
+            return flatten
+            
+        elif subType == TagSubType.Tuple:
+            elements = [self.makeFlattener(x, indices) for x in node[2]]
+            
+            def flatten(obj, values):
+                value = obj.value
+                
+                for i in xrange( len(elements) ):
+                    elements[i](value[i], values)
+                    
+            return flatten
+            
+    def compileEncoder(self, typ):
+        layout = TagReader.compileLayout(typ)
         
-    def addPatch(self, typ):
+        if layout == None:
+            return None
+            
+        node, compiled, indices = layout
+        flatten = self.makeFlattener(node, indices)
+        count = len(indices)
+        
+        def encode(data, obj, offset):
+            values = [0] * count
+            flatten(obj, values)
+            compiled.pack_into(data, offset, *values)
+            
+        return encode
+        
+    def getEncoder(self, typ):
+        if not self.encoders.has_key(typ):
+            self.encoders[typ] = self.compileEncoder(typ)
+            
+        return self.encoders[typ]
+        
+    def addPatch(self, typ, offset):
         if self.patches.has_key(typ):
-            self.patches[typ].append(self.f.tell())
+            self.patches[typ].append(self.dataOffset + offset)
             
         else:
-            self.patches[typ] = [self.f.tell()]
+            self.patches[typ] = [self.dataOffset + offset]
         
     def writeFormat(self, format, *args):
         self.f.write(struct.pack(format, *args))
@@ -711,6 +1482,15 @@ class TagWriter(object):
     def writeNulls(self, amount):
         self.f.write("\0" * amount)
         
+    @staticmethod
+    def align(offset, alignment):
+        amount = alignment - offset % alignment
+        
+        if amount != alignment:
+            return offset + amount
+            
+        return offset
+        
     def pad(self, alignment):
         amount = alignment - self.f.tell() % alignment
         
@@ -754,50 +1534,68 @@ class TagWriter(object):
             
         obj.attachment = item
         
+        self.itemIndices[item] = len(self.items)
         self.items.append(item)
         self.items2.append(item)
         
         return item
     
     def scanType(self, typ):
-        if typ != None and not typ in self.types:
-            self.types.append(typ)            
+        if typ == None or typ in self.typeIndices:
+            return
             
-            for template in typ.templates:
-                if template.isType:
-                    self.scanType(template.value)
+        stack = [typ]
+        
+        # Children go on the stack reversed, so types are numbered in the same order as a recursive walk
+        while stack:
+            typ = stack.pop()
+            
+            if typ == None or typ in self.typeIndices:
+                continue
                 
-            self.scanType(typ.parent)
-            self.scanType(typ.pointer)
+            self.typeIndices[typ] = len(self.types)
+            self.types.append(typ)
+            self.typeNames.setdefault(typ.name, typ)
             
-            for member in typ.members:
-                self.scanType(member.typ)
-        
-            for iTyp, flag in typ.interfaces:
-                self.scanType(iTyp)
+            children = [x.value for x in typ.templates if x.isType]
+            children += [typ.parent, typ.pointer]
+            children += [x.typ for x in typ.members]
+            children += [x for x, flag in typ.interfaces]
+            
+            stack.extend(reversed(children))
     
     def scanObjectForType(self, obj):
-        if obj == None:
-            return
-    
-        self.scanType(obj.typ)
-            
-        if obj.typ.superType.subType == TagSubType.Pointer:
-            self.scanObjectForType(obj.value)
+        stack = [obj]
+        visited = {}
         
-        elif obj.typ.superType.subType == TagSubType.Class:
-            for member in obj.typ.allMembers:
-                if obj.value.has_key(member.name):
-                    self.scanObjectForType(obj.value[member.name])
+        while stack:
+            obj = stack.pop()
+            
+            # Keep the objects alive too, so their ids can't be reused
+            if obj == None or visited.has_key(id(obj)):
+                continue
+                
+            visited[id(obj)] = obj
+            self.scanType(obj.typ)
+            
+            subType = obj.typ.superType.subType
+            
+            if subType == TagSubType.Pointer:
+                stack.append(obj.value)
+            
+            elif subType == TagSubType.Class:
+                stack.extend(reversed([obj.value[x.name] for x in obj.typ.allMembers if obj.value.has_key(x.name)]))
+                
+            elif isinstance(obj.value, TagArray):
+                # Every element has the array's type
+                if len(obj.value) > 0:
+                    self.scanType(obj.value.typ)
                     
-        elif obj.typ.superType.subType & 0xF == TagSubType.Array:
-            for obj2 in obj.value:
-                self.scanObjectForType(obj2)
+            elif subType & 0xF == TagSubType.Array:
+                stack.extend(reversed(list(obj.value)))
                         
     def getType(self, name):
-        for typ in self.types[1:]:
-            if typ.name == name:
-                return typ
+        return self.typeNames.get(name)
                 
 class TagTypeHelper(object):
     @staticmethod
@@ -815,7 +1613,119 @@ class TagTypeHelper(object):
             return default
 
     @staticmethod
-    def loadTypes(inputFileName):
+    def packTypes(types):
+        indices = {None:-1}
+        
+        for i in xrange( len(types) ):
+            if types[i] != None:
+                indices[types[i]] = i
+                
+        rows = []
+        for typ in types:
+            if typ == None:
+                rows.append(None)
+                continue
+                
+            rows.append((typ.name, indices[typ.parent], typ.flags, typ.subTypeFlags, indices[typ.pointer],
+            	typ.version, typ.byteSize, typ.alignment, typ.abstractValue, typ.hsh,
+            	[(x.name, indices[x.value] if x.isType else x.value) for x in typ.templates],
+            	[(x.name, x.flags, x.byteOffset, indices[x.typ]) for x in typ.members],
+            	[(indices[x], flag) for x, flag in typ.interfaces]))
+            	
+        return rows
+        
+    @staticmethod
+    def unpackTypes(rows):
+        types = [TagType() if x != None else None for x in rows]
+        getType = lambda index: types[index] if index >= 0 else None
+        
+        for typ, row in zip(types, rows):
+            if typ == None:
+                continue
+                
+            (typ.name, parent, typ.flags, typ.subTypeFlags, pointer, typ.version, typ.byteSize,
+            	typ.alignment, typ.abstractValue, typ.hsh, templates, members, interfaces) = row
+            	
+            typ.parent = getType(parent)
+            typ.pointer = getType(pointer)
+            
+            for name, value in templates:
+                template = TagTemplate(name, value)
+                
+                if template.isType:
+                    template.value = getType(value)
+                    
+                typ.templates.append(template)
+                
+            for name, flags, byteOffset, memberType in members:
+                member = TagMember()
+                member.name = name
+                member.flags = flags
+                member.byteOffset = byteOffset
+                member.typ = getType(memberType)
+                typ.members.append(member)
+                
+            typ.interfaces = [(getType(index), flag) for index, flag in interfaces]
+            
+        return types
+        
+    @staticmethod
+    def readCache(cacheFileName, key):
+        # Marshal can't run code, and nothing is decoded unless the key matches
+        try:
+            with open(cacheFileName, "rb") as f:
+                if f.readline() != key + "\n":
+                    return None
+                    
+                return marshal.load(f)
+                
+        except Exception:
+            return None
+        
+    @staticmethod
+    def writeCache(cacheFileName, key, value):
+        tempFileName = "{}.{}".format(cacheFileName, os.getpid())
+        
+        # The cache is only an optimization, an unwritable location is fine
+        try:
+            directory = os.path.dirname(cacheFileName)
+            
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+                
+            with open(tempFileName, "wb") as f:
+                f.write(key + "\n")
+                marshal.dump(value, f)
+                
+            if os.path.exists(cacheFileName):
+                os.remove(cacheFileName)
+                
+            os.rename(tempFileName, cacheFileName)
+            
+        except EnvironmentError:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+            
+    @staticmethod
+    def loadTypes(inputFileName, cacheFileName = None):
+        if cacheFileName == None:
+            cacheFileName = inputFileName + ".cache"
+            
+        with open(inputFileName, "rb") as f:
+            key = hashlib.sha1( f.read() ).hexdigest()
+            
+        rows = TagTypeHelper.readCache(cacheFileName, key)
+        
+        if rows != None:
+            return TagTypeHelper.unpackTypes(rows)
+            
+        types = TagTypeHelper.parseTypes(inputFileName)
+        TagTypeHelper.writeCache(cacheFileName, key, TagTypeHelper.packTypes(types))
+        
+        return types
+        
+    @staticmethod
+    def parseTypes(inputFileName):
         rootElem = ET.parse(inputFileName)
         typeElems = list( rootElem.findall("type") )
         typeElems.sort(key = lambda x: int( x.get("id") ))
@@ -862,32 +1772,109 @@ class TagTypeHelper(object):
         return types[1:]
         
 class TagXmlParser(object):
-    def __init__(self, rootElem, types):
+    def __init__(self, types):
         self.types = types
-        self.objectElems = list( rootElem.findall("object") )
-        self.objects = [None] + [TagObject(None, None) for x in xrange( len(self.objectElems) )]
-        self.objectElems.sort(key = lambda x: self.parseObjId( x.get("id") ))
+        self.typeNames = {}
+        self.objects = {}
+        self.objectIds = {}
+        
+        for typ in types:
+            if typ:
+                self.typeNames.setdefault(typ.name.replace("::", ""), typ)
     
     @staticmethod
     def fromFile(inputFileName, types, objName = "hkRootLevelContainer"):
-        return TagXmlParser(ET.parse(inputFileName), types).findObject(objName)
+        parser = TagXmlParser(types)
+        parser.parse(inputFileName)
+        return parser.findObject(objName)
+        
+    def parse(self, source):
+        rootElem = None
+        depth = 0
+        
+        # Convert every object as soon as its element is complete, then drop it
+        for event, elem in ET.iterparse(source, ("start", "end")):
+            if event == "start":
+                if rootElem == None:
+                    rootElem = elem
+                    
+                depth += 1
+                continue
+                
+            depth -= 1
+            
+            if depth == 1:
+                if elem.tag == "object":
+                    self.parseObject(elem)
+                    
+                rootElem.clear()
     
     def findType(self, name):
-        name = name.replace("::", "")
-    
-        for typ in self.types:
-            if typ and typ.name.replace("::", "") == name:
-                return typ
+        return self.typeNames.get(name.replace("::", ""))
                 
     def findObject(self, name):
         if isinstance(name, TagType):
             name = name.name
             
-        name = name.replace("::", "")
-    
-        for i in xrange( len(self.objectElems) ):    
-            if self.objectElems[i].get("type") == name:
-                return self.parseObject(i + 1)
+        index = self.objectIds.get(name.replace("::", ""))
+        
+        if index != None and self.objects[index].typ != None:
+            if all(x.typ != None for x in self.objects.itervalues()):
+                return self.objects[index]
+                
+            return self.pruneObject(self.objects[index])
+            
+    def getObject(self, index):
+        obj = self.objects.get(index)
+        
+        if obj == None:
+            obj = TagObject(None, None)
+            self.objects[index] = obj
+            
+        return obj
+        
+    def pruneObject(self, obj):
+        # Forward references are only known once the whole file has been read,
+        # so the rules for missing objects are applied here, until nothing else goes
+        pruned = True
+        
+        while pruned:
+            pruned = False
+            
+            for obj2 in self.objects.itervalues():
+                if obj2.typ != None and self.pruneValue(obj2) == None:
+                    obj2.value = None
+                    obj2.typ = None
+                    pruned = True
+                    
+        return obj if obj.typ != None else None
+        
+    def pruneValue(self, obj):
+        typ = obj.typ.superType
+        
+        if typ.subType == TagSubType.Pointer:
+            if obj.value != None and obj.value.typ == None:
+                return None
+                
+        elif typ.subType == TagSubType.Class:
+            # Any invalid type: death sentence
+            for value in obj.value.itervalues():
+                if self.pruneValue(value) == None:
+                    return None
+                    
+        elif typ.subType & 0xF == TagSubType.Array and not isinstance(obj.value, TagArray):
+            subType = typ.pointer.superType.subType
+            
+            # Pointers in arrays become null, structs are left out
+            if subType == TagSubType.Pointer:
+                for value in obj.value:
+                    if value.value != None and value.value.typ == None:
+                        value.value = None
+                        
+            elif subType == TagSubType.Class or subType & 0xF == TagSubType.Array:
+                obj.value[:] = [x for x in obj.value if self.pruneValue(x) != None]
+                
+        return obj
     
     def parseObjId(self, val):
         if val.startswith("#"):
@@ -899,22 +1886,63 @@ class TagXmlParser(object):
         return struct.unpack("f", struct.pack("I", int(text[1:], 16)))[0]
         
     def splitNumArray(self, text):
-        prettyString = text.strip().replace("\n", "").replace("\r", "")
-        return [x for x in prettyString.split(" ") if x]
+        return text.split() if text else []
+        
+    def parseFloats(self, text):
+        values = array.array("I", [int(x[1:], 16) for x in self.splitNumArray(text)])
+        return array.array("f", values.tostring())
         
     def parseNumArray(self, typ, text):
+        if typ.superType.subType == TagSubType.Float:
+            return [TagObject(x, typ) for x in self.parseFloats(text)]
+            
         return [self.parseValueText(typ, x) for x in self.splitNumArray(text)]
         
+    def parsePackedArray(self, typ, text):
+        arrayType = TagReader.makeArrayType(typ)
+        
+        if arrayType == None:
+            return None
+            
+        code, stride = arrayType
+        
+        if code == "f":
+            values = self.parseFloats(text)
+            
+        else:
+            try:
+                values = array.array(code, [int(x) for x in self.splitNumArray(text)])
+                
+            # Out of range values take the slow path, the writer masks them
+            except OverflowError:
+                return None
+            
+        if len(values) % stride:
+            return None
+            
+        return TagArray(typ, values, stride)
+        
     def parseArray(self, typ, elem):
         pointer = typ.superType.pointer.superType
+        isArray = typ.superType.subType == TagSubType.Array
         
         value = None
         if pointer.subType >= TagSubType.Bool and pointer.subType <= TagSubType.Float and pointer.subType != TagSubType.String:
-            value = self.parseNumArray(typ.superType.pointer, elem.text)
+            if isArray:
+                value = self.parsePackedArray(typ.superType.pointer, elem.text)
             
-        else:
+            if value == None:
+                value = self.parseNumArray(typ.superType.pointer, elem.text)
+            
+        elif isArray and pointer.subType == TagSubType.Tuple:
+            value = self.parsePackedArray(typ.superType.pointer, " ".join(x.text or "" for x in elem))
+            
+        if value == None:
             value = [self.parseValue(typ.superType.pointer, x) for x in elem]
             
+        if isinstance(value, TagArray):
+            return TagObject(value, typ)
+            
         return TagObject([x for x in value if x], typ)
         
     def parseValueText(self, typ, text):
@@ -942,7 +1970,10 @@ class TagXmlParser(object):
             return self.parseValueText(typ, elem.text)
             
         elif typ.superType.subType == TagSubType.Pointer:
-            return TagObject(self.parseObject(self.parseObjId(elem.text)), typ)
+            index = self.parseObjId(elem.text)
+            
+            # Null references stay empty, the rest are resolved once the whole file is read
+            return TagObject(self.getObject(index) if index != 0 else None, typ)
             
         elif typ.superType.subType == TagSubType.Class:
             members = {x.name:x for x in typ.superType.allMembers}
@@ -958,7 +1989,7 @@ class TagXmlParser(object):
                 members[name] = value
         
             if typ.superType.name == "hkQsTransformf":
-                floats = [TagObject(self.parseFloat(x), self.findType("float")) for x in self.splitNumArray(elem.text)]
+                floats = self.parseNumArray(self.findType("float"), elem.text)
                 
                 members["translation"] = TagObject(floats[:4], members["translation"].typ)
                 members["rotation"] = TagObject(floats[4:8], members["rotation"].typ)
@@ -969,23 +2000,26 @@ class TagXmlParser(object):
         elif typ.superType.subType & 0xF == TagSubType.Array:
             return self.parseArray(typ, elem)
         
-    def parseObject(self, index):
-        obj = self.objects[index]
-        objElem = self.objectElems[index - 1]
+    def parseObject(self, objElem):
+        index = self.parseObjId( objElem.get("id") )
+        obj = self.getObject(index)
         
-        if obj.value == None or obj.typ == None:
-            typ = self.findType( objElem.get("type") )
-            
-            if typ == None:    
-                print "WARNING: Type '{}' could not be found in the type database!".format( objElem.get("type") )
-                return
+        typName = objElem.get("type")
         
-            obj2 = self.parseValue(typ, objElem)
-            
+        if index < self.objectIds.get(typName, index + 1):
+            self.objectIds[typName] = index
+        
+        typ = self.findType(typName)
+        
+        if typ == None:    
+            print "WARNING: Type '{}' could not be found in the type database!".format(typName)
+            return
+        
+        obj2 = self.parseValue(typ, objElem)
+        
+        if obj2 != None:
             obj.value = obj2.value
             obj.typ = obj2.typ
-
-        return obj
         
 TagXmlSerializerSpecialTypeNames = {
     "hkcdStaticTreeDynamicStoragehkcdStaticTreeCodec3Axis4":"hkcdStaticTreeDynamicStorage4",
@@ -997,6 +2031,7 @@ TagXmlSerializerSpecialTypeNames = {
 class TagXmlSerializer(object):
     def __init__(self, backporter = None):
         self.types = []
+        self.scannedTypes = set()
         self.objects = []
         self.objCounter = 0
         self.backporter = backporter
@@ -1004,8 +2039,34 @@ class TagXmlSerializer(object):
     @staticmethod
     def toFile(outputFileName, obj, backporter = None):
         with open(outputFileName, "w") as f:
-            f.write('<?xml version="1.0" encoding="ascii"?>\n')
-            ET.ElementTree(TagXmlSerializer(backporter).serialize(obj)).write(f)
+            TagXmlSerializer.toStream(f, obj, backporter)
+            
+    @staticmethod
+    def toStream(f, obj, backporter = None):
+        f.write('<?xml version="1.0" encoding="ascii"?>\n')
+        TagXmlSerializer(backporter).serialize(f, obj)
+        
+    @staticmethod
+    def escapeText(text):
+        if "&" in text:
+            text = text.replace("&", "&amp;")
+        if "<" in text:
+            text = text.replace("<", "&lt;")
+        if ">" in text:
+            text = text.replace(">", "&gt;")
+            
+        return text.encode("us-ascii", "xmlcharrefreplace")
+        
+    @staticmethod
+    def escapeAttrib(text):
+        text = TagXmlSerializer.escapeText(text)
+        
+        if "\"" in text:
+            text = text.replace("\"", "&quot;")
+        if "\n" in text:
+            text = text.replace("\n", "&#10;")
+            
+        return text
         
     def getIdString(self, index):
         return "#{:04}".format(index)
@@ -1064,6 +2125,15 @@ class TagXmlSerializer(object):
     def getFloatString(self, value):
         return "x{:08x}".format(struct.unpack("I", struct.pack("f", value))[0])
         
+    def getFloatStrings(self, objs):
+        if isinstance(objs, TagArray) and objs.values.typecode == "f":
+            values = objs.values
+        else:
+            values = array.array("f", [x.value for x in objs])
+            
+        # Reinterpret the whole buffer once instead of packing every float
+        return ["x%08x" % x for x in array.array("I", values.tostring())]
+        
     def getValueString(self, obj):
         typ = obj.typ.superType
         
@@ -1077,141 +2147,192 @@ class TagXmlSerializer(object):
             return self.getFloatString(obj.value)
 
     def makeNumArray(self, obj):
-        index = 16 if obj.typ.superType.pointer.superType.byteSize == 1 else 8
+        pointer = obj.typ.superType.pointer.superType
+        index = 16 if pointer.byteSize == 1 else 8
         
-        result = ""
-        for i in xrange( len(obj.value) ):
-            if not i % index:
-                result += "\n"
+        if isinstance(obj.value, TagArray) and pointer.subType == TagSubType.Int:
+            values = [str(x) for x in obj.value.values]
+        elif pointer.subType == TagSubType.Int:
+            values = [str(x.value) for x in obj.value]
+        else:
+            values = [self.getValueString(x) for x in obj.value]
         
-            result += self.getValueString(obj.value[i]) + " "
-                
-        return result[:-1]
+        return " ".join(["\n" + " ".join(values[i:i + index]) for i in xrange(0, len(values), index)])
 
-    def serializeObject(self, parent, obj):
-        if (hasattr(obj.value, "__len__") and len(obj.value) > 0) or obj.value:
-            elem = ET.SubElement(parent, self.getSubTypeName(obj.typ))
+    @staticmethod
+    def hasValue(obj):
+        return (hasattr(obj.value, "__len__") and len(obj.value) > 0) or obj.value
+        
+    @staticmethod
+    def writeStartTag(parts, tag, attrib):
+        parts.append("<" + tag)
+        
+        for key, value in sorted(attrib.iteritems()):
+            parts.append(' {}="{}"'.format(key, TagXmlSerializer.escapeAttrib(value)))
+            
+    @staticmethod
+    def writeElement(parts, tag, attrib, text, level):
+        TagXmlSerializer.writeStartTag(parts, tag, attrib)
+        
+        indent = "\n" + level * "  "
+        
+        # Same layout ElementTree produces for an indented leaf element
+        if text and text.startswith("\n"):
+            text = text.replace("\n", indent + "  ") + indent
             
-            typ = obj.typ.superType
+        elif tag == "class" or tag == "struct":
+            text = indent
             
-            if typ.subType == TagSubType.Bool:
-                elem.text = str(1 if obj.value else 0)
-                
-            elif typ.subType == TagSubType.String:
-                elem.text = obj.value
+        if text:
+            parts.append(">" + TagXmlSerializer.escapeText(text) + "</" + tag + ">")
+            
+        else:
+            parts.append(" />")
+            
+    def serializeObject(self, parts, obj, level, attrib, tag = None):
+        typ = obj.typ.superType
+        
+        elemTag = self.getSubTypeName(obj.typ)
+        text = None
+        children = []
+        
+        if typ.subType == TagSubType.Bool:
+            text = str(1 if obj.value else 0)
+            
+        elif typ.subType == TagSubType.String:
+            text = obj.value
+            
+        elif typ.subType == TagSubType.Int:
+            text = str(obj.value)
+            
+        elif typ.subType == TagSubType.Float:
+            text = self.getFloatString(obj.value)
+            
+        elif typ.subType == TagSubType.Pointer:
+            text = self.getIdString(obj.value.attachment)
+            
+        elif typ.subType == TagSubType.Class:
+            # hkQsTransformf
+            if typ.name == "hkQsTransformf":
+                floats = obj.value["translation"].value + obj.value["rotation"].value + obj.value["scale"].value
+                	
+                elemTag = "vec12"
+                text = " ".join(self.getFloatStrings(floats))
+            
+            else:
+                for member in typ.allMembers:
+                    if not member.flags & 1 and obj.value.has_key(member.name):
+                        obj2 = obj.value[member.name]
+                        
+                        if self.hasValue(obj2):
+                            children.append((obj2, {"name":member.name},
+                            	self.getSubTypeName(member.tag) if member.tag else None))
+                             
+        elif typ.subType & 0xF == TagSubType.Array:
+            pointer = typ.pointer.superType
+            
+            if pointer.subType == TagSubType.Bool or pointer.subType == TagSubType.Int:
+                text = self.makeNumArray(obj)
                 
-            elif typ.subType == TagSubType.Int:
-                elem.text = str(obj.value)
+            elif pointer.subType == TagSubType.Float:
+                text = " ".join(self.getFloatStrings(obj.value))
+    
+            else:
+                children = [(x, {}, None) for x in obj.value if self.hasValue(x)]
+                    
+            if typ.subType == TagSubType.Array:
+                attrib["size"] = str( len(obj.value) )
                 
-            elif typ.subType == TagSubType.Float:
-                elem.text = self.getFloatString(obj.value)
+            elif typ.subType == TagSubType.Tuple:
+                attrib["size"] = str(typ.tupleSize)
                 
-            elif typ.subType == TagSubType.Pointer:
-                elem.text = self.getIdString(obj.value.attachment)
+            # hkVector4
+            if typ.tupleSize == 4 and pointer.subType == TagSubType.Float:
+                elemTag = "vec4"
+                attrib.pop("size", None)
                 
-            elif typ.subType == TagSubType.Class:
-                # hkQsTransformf
-                if typ.name == "hkQsTransformf":
-                    floats = [x.value for x in
-                    	obj.value["translation"].value + obj.value["rotation"].value + obj.value["scale"].value]
-                    	
-                    elem.tag = "vec12"
-                    elem.text = " ".join([self.getFloatString(x) for x in floats])
+            # hkMatrix4f
+            elif typ.tupleSize == 16 and pointer.subType == TagSubType.Float:
+                elemTag = "vec16"
+                attrib.pop("size", None)
                 
-                else:
-                    for member in typ.allMembers:
-                        if not member.flags & 1 and obj.value.has_key(member.name):
-                            memberElem = self.serializeObject(elem, obj.value[member.name])
-                            
-                            if memberElem != None:
-                                memberElem.set("name", member.name)
-                                
-                            if member.tag:
-                                memberElem.tag = self.getSubTypeName(member.tag)
-                                 
-            elif typ.subType & 0xF == TagSubType.Array:
-                pointer = typ.pointer.superType
-                
-                if pointer.subType == TagSubType.Bool or pointer.subType == TagSubType.Int:
-                    elem.text = self.makeNumArray(obj)
-                    
-                elif pointer.subType == TagSubType.Float:
-                    elem.text = " ".join([self.getFloatString(x.value) for x in obj.value])
+        if tag == None:
+            tag = elemTag
+            
+        if not children:
+            TagXmlSerializer.writeElement(parts, tag, attrib, text, level)
+            return
+            
+        indent = "\n" + level * "  "
         
-                else:
-                    for obj2 in obj.value:    
-                        self.serializeObject(elem, obj2)
-                        
-                if typ.subType == TagSubType.Array:
-                    elem.set("size", str( len(obj.value) ))
-                    
-                elif typ.subType == TagSubType.Tuple:
-                    elem.set("size", str(typ.tupleSize))
-                    
-                # hkVector4
-                if typ.tupleSize == 4 and pointer.subType == TagSubType.Float:
-                    elem.tag = "vec4"
-                    elem.attrib.pop("size")
-                    
-                # hkMatrix4f
-                elif typ.tupleSize == 16 and pointer.subType == TagSubType.Float:
-                    elem.tag = "vec16"
-                    elem.attrib.pop("size")
+        TagXmlSerializer.writeStartTag(parts, tag, attrib)
+        parts.append(">")
         
-            return elem
+        for obj2, attrib2, tag2 in children:
+            parts.append(indent + "  ")
+            self.serializeObject(parts, obj2, level + 1, attrib2, tag2)
+            
+        parts.append(indent + "</" + tag + ">")
             
-    def serializeMemberProp(self, parent, typ):
+    def serializeMemberProp(self, attrib, typ):
         if typ == None:
             return
     
         typ = typ.superType
         
-        parent.set("type", self.getSubTypeName(typ))
+        attrib["type"] = self.getSubTypeName(typ)
         
         if typ.subType == TagSubType.Pointer:
-            parent.set("class", self.getTypeName(typ.pointer))
+            attrib["class"] = self.getTypeName(typ.pointer)
             
         elif typ.subType == TagSubType.Class:
             if typ.name == "hkQsTransformf":
-                parent.set("type", "vec12")
+                attrib["type"] = "vec12"
                 
             else:
-                parent.set("class", self.getTypeName(typ))
+                attrib["class"] = self.getTypeName(typ)
                 
         elif typ.subType == TagSubType.Array:
-            parent.set("array", "true")
-            self.serializeMemberProp(parent, typ.pointer)
+            attrib["array"] = "true"
+            self.serializeMemberProp(attrib, typ.pointer)
             
         elif typ.subType == TagSubType.Tuple:
             if typ.pointer.superType.subType == TagSubType.Float and typ.tupleSize == 4:
-                parent.set("type", "vec4")
+                attrib["type"] = "vec4"
                 
             elif typ.pointer.superType.subType == TagSubType.Float and typ.tupleSize == 16:
-                parent.set("type", "vec16")
+                attrib["type"] = "vec16"
 
             else:
-                parent.set("count", str(typ.tupleSize))
-                self.serializeMemberProp(parent, typ.pointer)
+                attrib["count"] = str(typ.tupleSize)
+                self.serializeMemberProp(attrib, typ.pointer)
   
-    def serializeType(self, parent, typ):
-        elem = ET.SubElement(parent, "class")
-        elem.set("name", self.getTypeName(typ, True))
-        elem.set("version", str(typ.version))
+    def serializeType(self, parts, typ):
+        attrib = {"name":self.getTypeName(typ, True), "version":str(typ.version)}
         
         if typ.parent != None:
-            elem.set("parent", self.getTypeName(typ.parent))
+            attrib["parent"] = self.getTypeName(typ.parent)
+            
+        if not typ.members:
+            TagXmlSerializer.writeElement(parts, "class", attrib, None, 1)
+            return
+            
+        TagXmlSerializer.writeStartTag(parts, "class", attrib)
+        parts.append(">")
             
         for member in typ.members:
-            memberElem = ET.SubElement(elem, "member")
-            memberElem.set("name", member.name)
-            self.serializeMemberProp(memberElem, member.tag if member.tag else member.typ)
+            memberAttrib = {"name":member.name}
+            self.serializeMemberProp(memberAttrib, member.tag if member.tag else member.typ)
             
             if member.flags & 1:
-                memberElem.set("type", "void")
-    
-        return elem
+                memberAttrib["type"] = "void"
+                
+            parts.append("\n    ")
+            TagXmlSerializer.writeElement(parts, "member", memberAttrib, None, 2)
+            
+        parts.append("\n  </class>")
         
-    def serialize(self, obj):
+    def serialize(self, f, obj):
         self.objects.append(obj)
         self.objCounter += 1
         obj.attachment = self.objCounter              
@@ -1220,87 +2341,99 @@ class TagXmlSerializer(object):
         if self.backporter != None:
             self.backporter(self.types)
         
-        rootElem = ET.Element("hktagfile", {"version":"1", "sdkversion":"hk_2012.2.0-r1"})
+        parts = []
+        TagXmlSerializer.writeStartTag(parts, "hktagfile", {"version":"1", "sdkversion":"hk_2012.2.0-r1"})
+        parts.append(">")
         
+        # Every class and object goes out as soon as it is formatted
         for typ in self.types:
             if typ.subType == TagSubType.Class and typ.name != "hkQsTransformf":
-                self.serializeType(rootElem, typ)
+                parts.append("\n  ")
+                self.serializeType(parts, typ)
+                f.write("".join(parts))
+                del parts[:]
                 
         for obj2 in self.objects:
-            elem = self.serializeObject(rootElem, obj2)
-            elem.set("id", self.getIdString(obj2.attachment))
-            elem.set("type", self.getTypeName(obj2.typ.superType))
-            elem.tag = "object"
-          
-        TagXmlSerializer.indent(rootElem)      
-        return rootElem
-        
-    @staticmethod
-    def indent(elem, level=0, hor="  ", ver="\n"):
-        i = ver + level * hor
-        if len(elem):
-            if not elem.text or not elem.text.strip():
-                elem.text = i + hor
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-            for elem in elem:
-                TagXmlSerializer.indent(elem, level + 1, hor, ver)
-            if not elem.tail or not elem.tail.strip():
-                elem.tail = i
-        else:
-            if level and (not elem.tail or not elem.tail.strip()):
-                elem.tail = i
-                if elem.text and elem.text.startswith("\n"):
-                    elem.text = elem.text.replace("\n", i + hor) + i
-                elif (elem.tag == "class" or elem.tag == "struct") and not len(elem):
-                    elem.text = i
+            parts.append("\n  ")
+            self.serializeObject(parts, obj2, 1,
+            	{"id":self.getIdString(obj2.attachment), "type":self.getTypeName(obj2.typ.superType)}, "object")
+            f.write("".join(parts))
+            del parts[:]
+            
+        f.write("\n</hktagfile>\n")
         
     def scanType(self, typ):
-        if typ != None and not typ in self.types:
-            self.scanType(typ.parent)
-            self.scanType(typ.pointer)
-            
-            self.types.append(typ)
+        if typ == None or typ in self.scannedTypes:
+            return
             
-            for member in typ.members:
-                self.scanType(member.typ)
-
-            self.getTypeName(typ)
+        # Parents and pointed types are listed first, then the type, then its members
+        stack = [(typ, 0)]
+        
+        while stack:
+            typ, stage = stack.pop()
             
-            if TagXmlSerializerSpecialTypeNames.has_key(typ.tag):
-                specialName = TagXmlSerializerSpecialTypeNames[typ.tag]
+            if stage == 1:
+                self.types.append(typ)
+                self.scannedTypes.add(typ)
                 
-                # Create Fake Type
-                fakeType = TagType(specialName)
-                fakeType.subTypeFlags = 7
-                fakeType.tag = specialName
-                fakeType.parent = TagType(typ.tag)
-                self.types.append(fakeType)
+            elif stage == 2:
+                self.finishType(typ)
                 
-                typ.tag = specialName
-    
+            elif typ != None and not typ in self.scannedTypes:
+                stack.append((typ, 2))
+                stack.extend([(x.typ, 0) for x in reversed(typ.members)])
+                stack.append((typ, 1))
+                stack.append((typ.pointer, 0))
+                stack.append((typ.parent, 0))
+                
+    def finishType(self, typ):
+        self.getTypeName(typ)
+        
+        if TagXmlSerializerSpecialTypeNames.has_key(typ.tag):
+            specialName = TagXmlSerializerSpecialTypeNames[typ.tag]
+            
+            # Create Fake Type
+            fakeType = TagType(specialName)
+            fakeType.subTypeFlags = 7
+            fakeType.tag = specialName
+            fakeType.parent = TagType(typ.tag)
+            self.types.append(fakeType)
+            
+            typ.tag = specialName
 
     def scanObjectForType(self, obj):
-        if obj == None:
-            return
-    
-        self.scanType(obj.typ)
-        
-        if obj.typ.superType.subType == TagSubType.Pointer and obj.value and not obj.value.attachment:
-            self.objects.append(obj.value)
-            self.objCounter += 1
-            obj.value.attachment = self.objCounter
+        stack = [obj]
+        visited = {}
         
-            self.scanObjectForType(obj.value)
-        
-        elif obj.typ.superType.subType == TagSubType.Class:
-            for member in obj.typ.allMembers:
-                if obj.value.has_key(member.name):
-                    self.scanObjectForType(obj.value[member.name])
+        while stack:
+            obj = stack.pop()
+            
+            # Keep the objects alive too, so their ids can't be reused
+            if obj == None or visited.has_key(id(obj)):
+                continue
+                
+            visited[id(obj)] = obj
+            self.scanType(obj.typ)
+            
+            subType = obj.typ.superType.subType
+            
+            if subType == TagSubType.Pointer and obj.value and not obj.value.attachment:
+                self.objects.append(obj.value)
+                self.objCounter += 1
+                obj.value.attachment = self.objCounter
+                
+                stack.append(obj.value)
+            
+            elif subType == TagSubType.Class:
+                stack.extend(reversed([obj.value[x.name] for x in obj.typ.allMembers if obj.value.has_key(x.name)]))
+                
+            elif isinstance(obj.value, TagArray):
+                # Every element has the array's type
+                if len(obj.value) > 0:
+                    self.scanType(obj.value.typ)
                     
-        elif obj.typ.superType.subType & 0xF == TagSubType.Array:
-            for obj2 in obj.value:
-                self.scanObjectForType(obj2)
+            elif subType & 0xF == TagSubType.Array:
+                stack.extend(reversed(list(obj.value)))
         
 def findFile(fileName):
     for arg in sys.argv:
@@ -1319,76 +2452,84 @@ class TagTypeBackporter(object):
                 return member
 
     @staticmethod
-    def findType(types, name):
+    def indexTypes(types):
+        typeNames = {}
+        
         for typ in types:
-            if typ.name == name:
-                return typ
+            typeNames.setdefault(typ.name, typ)
+            
+        return typeNames
+
+    @staticmethod
+    def findType(typeNames, name):
+        return typeNames.get(name)
                 
     @staticmethod
     def backportTypes2012(types):
+        typeNames = TagTypeBackporter.indexTypes(types)
+        
         # hkReferencedObject
-        typ = TagTypeBackporter.findType(types, "hkReferencedObject")
+        typ = TagTypeBackporter.findType(typeNames, "hkReferencedObject")
         if typ != None and typ.version > 0:
             typ.version = 0
             typ.members.remove( TagTypeBackporter.findMember(typ, "propertyBag") )
             TagTypeBackporter.findMember(typ, "refCount").name = "referenceCount"
             
             # Remove anything related to property bag.
-            for typ in list(types):
-                if typ.name == "hkDefaultPropertyBag" or \
-                	typ.name.startswith("hkHash") or \
-                	typ.name == "hkTuple" or \
-                	typ.name == "hkPropertyId" or \
-                	typ.name == "hkPtrAndInt" or \
-                	typ.name == "hkPropertyDesc":
-                    types.remove(typ)
+            types[:] = [x for x in types if not (
+            	x.name == "hkDefaultPropertyBag" or
+            	x.name.startswith("hkHash") or
+            	x.name == "hkTuple" or
+            	x.name == "hkPropertyId" or
+            	x.name == "hkPtrAndInt" or
+            	x.name == "hkPropertyDesc")]
             
         # hkxMeshSection
-        typ = TagTypeBackporter.findType(types, "hkxMeshSection")
+        typ = TagTypeBackporter.findType(typeNames, "hkxMeshSection")
         if typ != None and typ.version > 4:
             typ.version = 4
             typ.members.remove( TagTypeBackporter.findMember(typ, "boneMatrixMap") )
         
         # hkxVertexBuffer::VertexData
-        typ = TagTypeBackporter.findType(types, "hkxVertexBuffer::VertexData")
+        typ = TagTypeBackporter.findType(typeNames, "hkxVertexBuffer::VertexData")
         if typ != None and typ.version > 0:
             typ.version = 0
         
         # hkxVertexDescription::ElementDecl
-        typ = TagTypeBackporter.findType(types, "hkxVertexDescription::ElementDecl")
+        typ = TagTypeBackporter.findType(typeNames, "hkxVertexDescription::ElementDecl")
         if typ != None and typ.version > 3:
             typ.version = 3
             typ.members.remove( TagTypeBackporter.findMember(typ, "channelID") )
         
         # hkxMaterial
-        typ = TagTypeBackporter.findType(types, "hkxMaterial")
+        typ = TagTypeBackporter.findType(typeNames, "hkxMaterial")
         if typ != None and typ.version > 4:
             typ.version = 4
             typ.members.remove( TagTypeBackporter.findMember(typ, "userData") )
         
         # hkaSkeleton
-        typ = TagTypeBackporter.findType(types, "hkaSkeleton")
+        typ = TagTypeBackporter.findType(typeNames, "hkaSkeleton")
         if typ != None and typ.version > 5:
             typ.version = 5
         
         # hkcdStaticMeshTreeBase
-        typ = TagTypeBackporter.findType(types, "hkcdStaticMeshTreeBase")
+        typ = TagTypeBackporter.findType(typeNames, "hkcdStaticMeshTreeBase")
         if typ != None and typ.version > 0:
             typ.version = 0
             typ.members.remove( TagTypeBackporter.findMember(typ, "primitiveStoresIsFlatConvex") )
         
         # hkaInterleavedUncompressedAnimation
-        typ = TagTypeBackporter.findType(types, "hkaInterleavedUncompressedAnimation")
+        typ = TagTypeBackporter.findType(typeNames, "hkaInterleavedUncompressedAnimation")
         if typ != None and typ.version > 0:
             typ.version = 0
             
         # hkpStaticCompundShape
-        typ = TagTypeBackporter.findType(types, "hkpStaticCompoundShape")
+        typ = TagTypeBackporter.findType(typeNames, "hkpStaticCompoundShape")
         if typ != None:
             TagTypeBackporter.findMember(typ, "numBitsForChildShapeKey").tag = TagTypeBackporter.findMember(typ, "instanceExtraInfos").typ.pointer
             
         # hkpStaticCompoundShape::Instance
-        typ = TagTypeBackporter.findType(types, "hkpStaticCompoundShape::Instance")
+        typ = TagTypeBackporter.findType(typeNames, "hkpStaticCompoundShape::Instance")
         if typ != None and typ.version > 0:
             typ.version = 0
             
@@ -1406,24 +2547,571 @@ def findFile(fileName, mandatory = True):
             
     return None
                 
+def makeTempFile(fileName):
+    # Unlike mkstemp, the file gets the permissions of any other new file
+    directory, name = os.path.split(os.path.abspath(fileName))
+    
+    while True:
+        tempFileName = tempfile.mktemp(".tmp", name + ".", directory)
+        
+        try:
+            os.close(os.open(tempFileName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666))
+            return tempFileName
+            
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+                
+def replaceFile(sourceFileName, destinationFileName):
+    if os.path.exists(destinationFileName):
+        shutil.copymode(destinationFileName, sourceFileName)
+        os.remove(destinationFileName)
+        
+    os.rename(sourceFileName, destinationFileName)
+    
+class TagScratchFile(object):
+    def __init__(self, scratchDir = None, usePipe = True):
+        self.directory = None
+        self.fileName = None
+        self.usePipe = usePipe and hasattr(os, "mkfifo") and fcntl != None
+        
+        if self.usePipe:
+            self.directory = tempfile.mkdtemp("", "TagTools", scratchDir)
+            self.fileName = os.path.join(self.directory, "temp.xml")
+            os.mkfifo(self.fileName)
+            
+        else:
+            handle, self.fileName = tempfile.mkstemp(".xml", "TagTools", scratchDir)
+            os.close(handle)
+            
+    def __enter__(self):
+        return self
+        
+    def __exit__(self, arg1, arg2, arg3):
+        if os.path.exists(self.fileName):
+            os.remove(self.fileName)
+            
+        if self.directory != None:
+            os.rmdir(self.directory)
+            
+    def openPipe(self, mode):
+        # Open both ends without blocking. The end we don't use stays open until
+        # the child exits, so neither side can wait forever on the other.
+        readHandle = os.open(self.fileName, os.O_RDONLY | os.O_NONBLOCK)
+        writeHandle = os.open(self.fileName, os.O_WRONLY | os.O_NONBLOCK)
+        
+        if mode == "r":
+            handle, otherHandle = readHandle, writeHandle
+        else:
+            handle, otherHandle = writeHandle, readHandle
+            
+        fcntl.fcntl(handle, fcntl.F_SETFL, fcntl.fcntl(handle, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        return os.fdopen(handle, mode + "b"), otherHandle
+        
+    @staticmethod
+    def checkExitCode(code):
+        if code != 0:
+            raise ValueError( "AssetCc2.exe failed with exit code {}".format( code ) )
+            
+    def runWithPipe(self, args, mode, method):
+        f, otherHandle = self.openPipe(mode)
+        process = subprocess.Popen(args, close_fds = True)
+        
+        def wait():
+            process.wait()
+            os.close(otherHandle)
+            
+        thread = threading.Thread(target = wait)
+        thread.daemon = True
+        thread.start()
+        
+        try:
+            with f:
+                try:
+                    result = method(f)
+                    
+                # Don't let AssetCc2 take a truncated document for a complete one
+                except:
+                    if process.poll() == None:
+                        process.kill()
+                        raise
+                        
+                    # A failing AssetCc2 explains a broken pipe or a cut off document
+                    TagScratchFile.checkExitCode(process.returncode)
+                    raise
+                
+        finally:
+            thread.join()
+            
+        TagScratchFile.checkExitCode(process.returncode)
+        return result
+        
+    def write(self, args, method):
+        if self.usePipe:
+            self.runWithPipe(args, "w", method)
+            
+        else:
+            with open(self.fileName, "w") as f:
+                method(f)
+                
+            TagScratchFile.checkExitCode(subprocess.call(args))
+            
+    def read(self, args, method):
+        if self.usePipe:
+            return self.runWithPipe(args, "r", method)
+            
+        TagScratchFile.checkExitCode(subprocess.call(args))
+        
+        with open(self.fileName, "rb") as f:
+            return method(f)
+            
+class TagConversionCache(object):
+    defaultSize = 1 << 30
+    
+    # Hashes of compendiums, the type database and AssetCc2, by file identity
+    hashes = {}
+    
+    def __init__(self, directory, maxSize = defaultSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        
+        # Batch workers may all get here at once
+        try:
+            os.makedirs(directory)
+            
+        except EnvironmentError:
+            if not os.path.isdir(directory):
+                raise
+                
+    @staticmethod
+    def hashFile(fileName):
+        sha = hashlib.sha1()
+        
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), ""):
+                sha.update(block)
+                
+        return sha.hexdigest()
+        
+    @staticmethod
+    def hashToolFile(fileName):
+        if ( fileName == None or not os.path.exists( fileName ) ):
+            return ""
+            
+        stat = os.stat(fileName)
+        fileKey = (os.path.abspath(fileName), stat.st_size, stat.st_mtime)
+        
+        if not TagConversionCache.hashes.has_key(fileKey):
+            TagConversionCache.hashes[fileKey] = TagConversionCache.hashFile(fileName)
+            
+        return TagConversionCache.hashes[fileKey]
+        
+    @staticmethod
+    def copyFile(sourceFileName, destinationFileName):
+        # Copy next to the destination first so nobody ever sees half a file
+        tempFileName = makeTempFile(destinationFileName)
+        
+        try:
+            shutil.copyfile(sourceFileName, tempFileName)
+            replaceFile(tempFileName, destinationFileName)
+            
+        finally:
+            if os.path.exists(tempFileName):
+                os.remove(tempFileName)
+                
+    @staticmethod
+    def getToolFileName():
+        if getattr(sys, "frozen", False):
+            return sys.executable
+            
+        fileName = os.path.abspath(__file__)
+        
+        if fileName.endswith((".pyc", ".pyo")) and os.path.exists(fileName[:-1]):
+            return fileName[:-1]
+            
+        return fileName
+        
+    def getKey(self, inputFileName, compendiumFileName):
+        sha = hashlib.sha1(TagConversionCache.hashFile(inputFileName))
+        
+        # Any change to this tool, the types or AssetCc2 can change the output.
+        # AssetCc2 also decides whether tag files turn into packfiles or XML.
+        for fileName in (TagConversionCache.getToolFileName(), compendiumFileName,
+        	findFile("TypeDatabase.xml", False), findFile("AssetCc2.exe", False)):
+            sha.update(":" + TagConversionCache.hashToolFile(fileName))
+            
+        return sha.hexdigest()
+        
+    def fetch(self, key, outputFileName):
+        fileName = os.path.join(self.directory, key)
+        
+        try:
+            TagConversionCache.copyFile(fileName, outputFileName)
+            
+            # The modification time doubles as the last use for eviction
+            os.utime(fileName, None)
+            
+        except EnvironmentError:
+            with self.lock:
+                self.misses += 1
+                
+            return False
+            
+        with self.lock:
+            self.hits += 1
+            
+        return True
+        
+    def store(self, key, outputFileName):
+        fileName = os.path.join(self.directory, key)
+        
+        # The cache is only an optimization, a failed store is fine
+        try:
+            TagConversionCache.copyFile(outputFileName, fileName)
+            size = os.path.getsize(fileName)
+            
+        except EnvironmentError:
+            return
+            
+        with self.lock:
+            if self.size != None:
+                self.size += size
+                
+            if self.size == None or self.size > self.maxSize:
+                self.evict()
+                
+    def evict(self):
+        entries = []
+        
+        for name in os.listdir(self.directory):
+            # Files still being copied have an extension
+            if "." in name:
+                continue
+                
+            fileName = os.path.join(self.directory, name)
+            
+            try:
+                stat = os.stat(fileName)
+                
+            except EnvironmentError:
+                continue
+                
+            entries.append((stat.st_mtime, stat.st_size, fileName))
+            
+        entries.sort()
+        self.size = sum(x[1] for x in entries)
+        
+        for mtime, size, fileName in entries:
+            if self.size <= self.maxSize:
+                break
+                
+            try:
+                os.remove(fileName)
+                
+            except EnvironmentError:
+                pass
+                
+            self.size -= size
+            
+def convertFile(inputFileName, outputFileName, compendium = None, types = None, scratchDir = None, usePipe = True, workers = 0):
+    if TagReader.checkFile(inputFileName) == TagFileType.Object:
+        assetCc2Path = findFile("AssetCc2.exe", False)
+        obj = TagReader.fromFile(inputFileName, compendium = compendium, workers = workers)
+        
+        if ( assetCc2Path == None ):
+            TagXmlSerializer.toFile(outputFileName, obj, TagTypeBackporter.backportTypes2012)
+            
+        else:
+            # The destination is often the source, only replace it once AssetCc2 is done
+            tempFileName = makeTempFile(outputFileName)
+            
+            try:
+                with TagScratchFile(scratchDir, usePipe) as scratch:
+                    scratch.write([assetCc2Path, "--strip", "--rules4101", scratch.fileName, tempFileName],
+                    	lambda f: TagXmlSerializer.toStream(f, obj, TagTypeBackporter.backportTypes2012))
+                    	
+                if os.path.getsize(tempFileName) == 0:
+                    raise ValueError( "AssetCc2.exe produced no output" )
+                    
+                replaceFile(tempFileName, outputFileName)
+                
+            finally:
+                if os.path.exists(tempFileName):
+                    os.remove(tempFileName)
+        
+    else:
+        if ( types == None ):
+            types = TagTypeHelper.loadTypes(findFile("TypeDatabase.xml"))
+            
+        with TagScratchFile(scratchDir, usePipe) as scratch:
+            obj = scratch.read([findFile("AssetCc2.exe"), "-g", "-x", inputFileName, scratch.fileName],
+            	lambda f: TagXmlParser.fromFile(f, types))
+            
+        TagWriter.toFile(outputFileName, obj)
+        
+def convertCachedFile(cache, inputFileName, outputFileName, compendiumFileName, types = None, scratchDir = None, usePipe = True, workers = 0):
+    key = None
+    
+    # The key is taken before converting, the output may replace the input
+    if ( cache != None ):
+        key = cache.getKey(inputFileName, compendiumFileName)
+        
+        if cache.fetch(key, outputFileName):
+            return True
+            
+    convertFile(inputFileName, outputFileName, TagReader.loadCompendium(compendiumFileName), types, scratchDir, usePipe, workers)
+    
+    # Only a complete conversion is worth keeping, convertFile raises on a failed run
+    if ( cache != None and os.path.getsize(outputFileName) > 0 ):
+        cache.store(key, outputFileName)
+        
+    return False
+    
+class TagBatch(object):
+    types = None
+    compendiumFileName = None
+    scratchDir = None
+    usePipe = True
+    cache = None
+    
+    @staticmethod
+    def findFiles(args):
+        inputFileNames = []
+        compendiumFileName = None
+        
+        for arg in args:
+            if os.path.isdir(arg):
+                fileNames = []
+                
+                for root, dirNames, names in os.walk(arg):
+                    fileNames += [os.path.join(root, x) for x in names if x.lower().endswith(".hkx")]
+                    
+            else:
+                fileNames = glob.glob(arg)
+                
+            for fileName in sorted(fileNames):
+                if ( TagReader.checkFile( fileName ) == TagFileType.Compendium ):
+                    if ( compendiumFileName == None ):
+                        compendiumFileName = fileName
+                        
+                elif not fileName in inputFileNames:
+                    inputFileNames.append(fileName)
+                    
+        return inputFileNames, compendiumFileName
+        
+    @staticmethod
+    def run(args, scratchDir = None, usePipe = True, cacheDir = None, cacheSize = TagConversionCache.defaultSize):
+        inputFileNames, compendiumFileName = TagBatch.findFiles(args)
+        
+        pool = multiprocessing.Pool(initializer = initBatchWorker,
+        	initargs = (compendiumFileName, findFile("TypeDatabase.xml", False), scratchDir, usePipe, cacheDir, cacheSize))
+        
+        failed = 0
+        hits = 0
+        for inputFileName, error, cached in pool.imap_unordered(convertBatchFile, inputFileNames):
+            if ( error != None ):
+                failed += 1
+                print "ERROR: {}: {}".format(inputFileName, error)
+                
+            elif cached:
+                hits += 1
+                print "Converted {} (cached)".format(inputFileName)
+                
+            else:
+                print "Converted {}".format(inputFileName)
+            
+        pool.close()
+        pool.join()
+        
+        print "\n{} file(s) converted, {} failed.".format(len(inputFileNames) - failed, failed)
+        
+        if ( cacheDir != None ):
+            # Workers only see their own stores, trim once more with all of them in place
+            TagConversionCache(cacheDir, cacheSize).evict()
+            
+            print "Cache: {} hit(s), {} miss(es).".format(hits, len(inputFileNames) - hits)
+        
+def initBatchWorker(compendiumFileName, typesFileName, scratchDir, usePipe, cacheDir, cacheSize):
+    if ( typesFileName != None ):
+        TagBatch.types = TagTypeHelper.loadTypes(typesFileName)
+        
+    if ( cacheDir != None ):
+        TagBatch.cache = TagConversionCache(cacheDir, cacheSize)
+        
+    TagBatch.compendiumFileName = compendiumFileName
+    TagBatch.scratchDir = scratchDir
+    TagBatch.usePipe = usePipe
+    
+def convertBatchFile(inputFileName):
+    try:
+        cached = convertCachedFile(TagBatch.cache, inputFileName, os.path.splitext( inputFileName )[ 0 ] + ".hkx",
+        	TagBatch.compendiumFileName, TagBatch.types, TagBatch.scratchDir, TagBatch.usePipe)
+        	
+    except Exception as e:
+        return inputFileName, str(e), False
+        
+    return inputFileName, None, cached
+    
+class TagServer(object):
+    def __init__(self, scratchDir = None, usePipe = True, cache = None):
+        self.scratchDir = scratchDir
+        self.usePipe = usePipe
+        self.cache = cache
+        self.types = None
+        
+        typesFileName = findFile("TypeDatabase.xml", False)
+        if ( typesFileName != None ):
+            self.types = TagTypeHelper.loadTypes(typesFileName)
+            
+    def handle(self, line):
+        inputFileName = None
+        
+        try:
+            job = json.loads(line)
+            inputFileName = job["input"]
+            outputFileName = job.get("output") or os.path.splitext( inputFileName )[ 0 ] + ".hkx"
+            
+            cached = convertCachedFile(self.cache, inputFileName, outputFileName, job.get("compendium"),
+            	self.types, self.scratchDir, self.usePipe)
+            	
+        except Exception as e:
+            return json.dumps({"input":inputFileName, "error":str(e)})
+            
+        return json.dumps({"input":inputFileName, "output":outputFileName, "cached":cached})
+        
+    def serveStream(self, inputStream, outputStream):
+        for line in iter(inputStream.readline, ""):
+            if line.strip():
+                outputStream.write(self.handle(line) + "\n")
+                outputStream.flush()
+                
+    def serveStdin(self):
+        # Replies get their own copy of stdout; anything else printed,
+        # including AssetCc2's output, goes to stderr instead
+        outputStream = os.fdopen(os.dup(sys.stdout.fileno()), "w")
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+        
+        with outputStream:
+            self.serveStream(sys.stdin, outputStream)
+            
+    def serveConnection(self, connection):
+        inputStream = connection.makefile("rb")
+        outputStream = connection.makefile("wb")
+        
+        # A client hanging up early only ends its own session
+        try:
+            self.serveStream(inputStream, outputStream)
+            
+        except EnvironmentError:
+            pass
+            
+        finally:
+            inputStream.close()
+            outputStream.close()
+            connection.close()
+            
+    @staticmethod
+    def removeSocket(socketFileName):
+        # Only clear away a stale socket, never a file the path happens to name
+        if os.path.exists(socketFileName) and stat.S_ISSOCK(os.stat(socketFileName).st_mode):
+            os.remove(socketFileName)
+            
+    def serveSocket(self, socketFileName):
+        TagServer.removeSocket(socketFileName)
+            
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        
+        try:
+            server.bind(socketFileName)
+            server.listen(5)
+            
+            while True:
+                connection, address = server.accept()
+                
+                # One thread per client so an idle connection doesn't hold up the rest
+                thread = threading.Thread(target = self.serveConnection, args = (connection,))
+                thread.daemon = True
+                thread.start()
+                    
+        finally:
+            server.close()
+            TagServer.removeSocket(socketFileName)
+                
 if __name__ == "__main__":
-    if len(sys.argv) <= 1:
+    multiprocessing.freeze_support()
+    
+    args = sys.argv[1:]
+    scratchDir = None
+    usePipe = True
+    workers = 0
+    cacheDir = None
+    cacheSize = TagConversionCache.defaultSize
+    
+    if "--temp" in args[:-1]:
+        index = args.index("--temp")
+        scratchDir = args[index + 1]
+        del args[index:index + 2]
+        
+    if "--jobs" in args[:-1]:
+        index = args.index("--jobs")
+        workers = int(args[index + 1])
+        del args[index:index + 2]
+        
+    if "--cache" in args[:-1]:
+        index = args.index("--cache")
+        cacheDir = args[index + 1]
+        del args[index:index + 2]
+        
+    if "--cache-size" in args[:-1]:
+        index = args.index("--cache-size")
+        cacheSize = int(args[index + 1]) << 20
+        del args[index:index + 2]
+        
+    if "--no-pipe" in args:
+        args.remove("--no-pipe")
+        usePipe = False
+    
+    if len(args) == 0:
         print "Tool for converting HKX (version <= 2012 2.0) files to 2016 1.0 tag binary files, and vice versa."
         print "\nUsage: {} [source] [compendium] [destination]".format(os.path.basename(sys.argv[0]))
+        print "       {} --batch [compendium] [directories or wildcards...]".format(os.path.basename(sys.argv[0]))
         print "Compendium file is needed for files that contain no type info."
         print "If no destination is included, the changes will be overwritten to the source."
         print "You can do a simple drag and drop that way."
+        print "Batch mode converts every .hkx file in place, using all CPU cores."
+        print "Intermediate files go to the system temp directory, use --temp [directory] to change it."
+        print "Where supported, AssetCc2 exchanges XML through a named pipe; --no-pipe uses a regular file."
+        print "Use --jobs [count] to decode a large tag file with several processes."
+        print "--cache [directory] keeps converted files and reuses them while the input, compendium and tools stay the same;"
+        print "--cache-size [MB] limits it, least recently used files go first (default 1024)."
+        print "\n       {} --serve [socket]".format(os.path.basename(sys.argv[0]))
+        print "Keeps running and converts jobs sent as JSON lines, e.g. {\"input\": \"a.hkx\", \"output\": \"b.hkx\", \"compendium\": \"c.compendium\"},"
+        print "read from stdin or from a Unix socket. Every job is answered with a JSON line."
         print "\nMade by Skyth."
         print "Press enter to continue..."
         raw_input()
+        
+    elif args[0] == "--batch":
+        TagBatch.run(args[1:], scratchDir, usePipe, cacheDir, cacheSize)
+        
+    elif args[0] == "--serve":
+        server = TagServer(scratchDir, usePipe, TagConversionCache(cacheDir, cacheSize) if cacheDir != None else None)
+        
+        if len(args) > 1:
+            server.serveSocket(args[1])
+        else:
+            server.serveStdin()
     
     else:
         inputFileName = None
-        inputFileType = TagFileType.Invalid
         compendiumFileName = None
         outputFileName = None
         
-        for arg in sys.argv[1:]:
+        for arg in args:
             if ( os.path.exists( arg ) ):
                 typ = TagReader.checkFile( arg )
             else:
@@ -1433,31 +3121,17 @@ if __name__ == "__main__":
                 compendiumFileName = arg
             elif ( inputFileName == None ):
                 inputFileName = arg
-                inputFileType = typ
             elif ( outputFileName == None ):
                 outputFileName = arg
                 
         if ( outputFileName == None ):
             outputFileName = os.path.splitext( inputFileName )[ 0 ] + ".hkx"
             
-        tempFileName = os.path.join(os.path.dirname(sys.argv[0]), "temp.xml")
-            
-        if inputFileType == TagFileType.Object:
-            assetCc2Path = findFile("AssetCc2.exe", False)
+        cache = None
+        if ( cacheDir != None ):
+            cache = TagConversionCache(cacheDir, cacheSize)
             
-            destinationFileName = tempFileName
-            if ( assetCc2Path == None ):
-                destinationFileName = outputFileName
-            
-            TagXmlSerializer.toFile(destinationFileName, TagReader.fromFile(inputFileName, compendiumFileName), TagTypeBackporter.backportTypes2012)
-            
-            if ( assetCc2Path != None ):
-                subprocess.call([assetCc2Path, "--strip", "--rules4101", tempFileName, outputFileName])
-            
-        else:
-            types = TagTypeHelper.loadTypes(findFile("TypeDatabase.xml"))
-            subprocess.call([findFile("AssetCc2.exe"), "-g", "-x", inputFileName, tempFileName])
-            TagWriter.toFile(outputFileName, TagXmlParser.fromFile(tempFileName, types))
-          
-        if os.path.exists(tempFileName):       
-            os.remove(tempFileName)
+        convertCachedFile(cache, inputFileName, outputFileName, compendiumFileName, scratchDir = scratchDir, usePipe = usePipe, workers = workers)
+        
+        if ( cache != None ):
+            print "Cache: {} hit(s), {} miss(es).".format(cache.hits, cache.misses)